@@ -0,0 +1,342 @@
+"""
+Latency and throughput benchmark for the OSC control servers.
+
+Runs dmx.py (with a probe output instead of the uDMX) or solenoides_osc.py
+(with the simulated GPIO backend) in this process, blasts OSC at it over
+localhost from a separate sender process, and reports messages per second,
+dropped messages, end-to-end latency from send to DMX frame / GPIO edge, and
+server CPU per message. dmxWin.py runs the same code as dmx.py.
+
+Examples:
+    python benchmark_osc.py dmx --mode thread --pattern sweep --rate 2000
+    python benchmark_osc.py solenoides --pattern chords --rate 500
+    python benchmark_osc.py all --seconds 3
+"""
+import argparse
+import asyncio
+import bisect
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from pythonosc import osc_bundle_builder, osc_message_builder, osc_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "solenoides"))
+
+import dmx
+import solenoides_osc
+
+PATTERNS = ("sweep", "chords", "random")
+COILS = list(solenoides_osc.solenoide_pines)
+HIT = 0.002  # Solenoid pulse length used by the benchmark (s)
+SOLENOID_HANDLERS = {name: getattr(solenoides_osc, name) for name in ("manejar_solenoide", "manejar_acorde")}
+
+
+# ------------------- Traffic -------------------
+
+def dmx_message(pattern, i, rng):
+    """
+    Channel/value pairs of one DMX benchmark packet.
+    sweep: 16 faders ramping; chords: bundle of 8 channels; random: any channel.
+    """
+    if pattern == "sweep":
+        pairs = [(i % 16, i % 256)]
+    elif pattern == "chords":
+        base = rng.randrange(0, 512 - 8)
+        pairs = [(base + k, (i + k) % 256) for k in range(8)]
+    else:
+        pairs = [(rng.randrange(512), rng.randrange(256))]
+    return pairs
+
+
+def build_dmx_packet(pairs):
+    if len(pairs) == 1:
+        channel, value = pairs[0]
+        msg = osc_message_builder.OscMessageBuilder(f"/dmx{channel + 1}")
+        msg.add_arg(value)
+        return msg.build().dgram
+    bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+    for channel, value in pairs:
+        msg = osc_message_builder.OscMessageBuilder(f"/dmx{channel + 1}")
+        msg.add_arg(value)
+        bundle.add_content(msg.build())
+    return bundle.build().dgram
+
+
+def solenoid_message(pattern, i, rng):
+    """
+    One solenoid benchmark packet as a list of coil indexes.
+    sweep: roll over the eight coils; chords: random /chord masks; random: any coil.
+    """
+    if pattern == "sweep":
+        return [i % len(COILS)]
+    if pattern == "chords":
+        mask = rng.randrange(1, 1 << len(COILS))
+        return [k for k in range(len(COILS)) if mask >> k & 1]
+    return [rng.randrange(len(COILS))]
+
+
+def build_solenoid_packet(coils, pattern):
+    if pattern == "chords":
+        msg = osc_message_builder.OscMessageBuilder("/chord")
+        msg.add_arg(sum(1 << k for k in coils))
+        msg.add_arg(HIT)
+        return msg.build().dgram
+    # Hit and release in one bundle, so edge detection re-arms for the next hit
+    bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+    for value in (HIT, 0.0):
+        msg = osc_message_builder.OscMessageBuilder(f"/{COILS[coils[0]]}")
+        msg.add_arg(value)
+        bundle.add_content(msg.build())
+    return bundle.build().dgram
+
+
+def traffic(target, pattern, count, seed):
+    """Deterministic list of (packet, probe) so sender and analysis agree on the content."""
+    rng = random.Random(seed)
+    packets = []
+    for i in range(count):
+        if target == "dmx":
+            pairs = dmx_message(pattern, i, rng)
+            packets.append((build_dmx_packet(pairs), pairs))
+        else:
+            coils = solenoid_message(pattern, i, rng)
+            packets.append((build_solenoid_packet(coils, pattern), coils))
+    return packets
+
+
+def sender(port, target, pattern, rate, count, seed, conn):
+    """Child process: send `count` packets at `rate` per second, return the send times."""
+    packets = [packet for packet, _ in traffic(target, pattern, count, seed)]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    times = []
+    start = time.monotonic() + 0.05
+    for i, packet in enumerate(packets):
+        due = start + i / rate
+        while True:
+            now = time.monotonic()
+            if now >= due:
+                break
+            if due - now > 0.002:
+                time.sleep(due - now - 0.001)
+        times.append(time.monotonic())
+        sock.sendto(packet, ("127.0.0.1", port))
+    conn.send(times)
+    conn.close()
+
+
+# ------------------- Servers under test -------------------
+
+class ProbeOutput(dmx.NullOutput):
+    """NullOutput that timestamps every transmitted span."""
+
+    def __init__(self):
+        super().__init__()
+        self.log = []  # (time, start, bytes)
+
+    def send(self, start, values):
+        super().send(start, values)
+        self.log.append((time.monotonic(), start, bytes(values)))
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def count_calls(function, counter):
+    def counted(*args):
+        counter[0] += 1
+        return function(*args)
+    return counted
+
+
+class DMXUnderTest:
+    def __init__(self, mode, refresh_rate):
+        self.output = ProbeOutput()
+        self.controller = dmx.DMXController({1: self.output}, refresh_rate=refresh_rate, mode=mode)
+        self.received = [0]
+        # Count messages as they reach the handlers (the dispatcher maps these attributes)
+        self.controller.update_from_osc = count_calls(self.controller.update_from_osc, self.received)
+        self.port = free_port()
+        self.mode = mode
+        if mode == "asyncio":
+            self.thread = threading.Thread(target=asyncio.run,
+                                           args=(dmx.serve_asyncio(self.controller, "127.0.0.1", self.port),))
+        else:
+            self.server = osc_server.BlockingOSCUDPServer(("127.0.0.1", self.port), dmx.make_dispatcher(self.controller))
+            self.server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, dmx.RECV_BUFFER)
+            self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        time.sleep(0.1)
+
+    def stop(self):
+        if self.mode == "asyncio":
+            self.controller.running = False
+        else:
+            self.server.shutdown()
+            self.server.server_close()
+        self.thread.join()
+        self.controller.running = False
+        if self.controller.sender_thread is not None:
+            self.controller.sender_thread.join()
+
+    def latencies(self, sends, probes):
+        """
+        Send-to-frame latency of each message, judged on its first channel: the
+        first transmitted span covering that channel after the send that carries
+        the value, or that went out after a newer write to the channel had been
+        sent (coalesced). Writes that leave the channel unchanged produce no
+        frame and are skipped; anything else that never shows up is lost.
+        """
+        covers = {}  # channel -> ([times], [values])
+        for when, start, values in self.output.log:
+            for offset, value in enumerate(values):
+                times, vals = covers.setdefault(start + offset, ([], []))
+                times.append(when)
+                vals.append(value)
+        later = {}  # index -> send time of the next message writing the same channel
+        last_seen = {}
+        for index in range(len(sends) - 1, -1, -1):
+            later[index] = last_seen.get(probes[index][0][0])
+            for channel, _ in probes[index]:
+                last_seen[channel] = sends[index]
+        result, lost = [], 0
+        current = bytearray(512)
+        for index, sent in enumerate(sends):
+            channel, value = probes[index][0]
+            unchanged = current[channel] == value
+            for pair_channel, pair_value in probes[index]:
+                current[pair_channel] = pair_value
+            if unchanged:
+                continue
+            times, vals = covers.get(channel, ([], []))
+            k = bisect.bisect_left(times, sent)
+            while k < len(times) and times[k] < sent + self.controller.keepalive:
+                if vals[k] == value or (later[index] is not None and later[index] < times[k]):
+                    result.append(times[k] - sent)
+                    break
+                k += 1
+            else:
+                lost += 1
+        return result, lost
+
+
+class SolenoidsUnderTest:
+    def __init__(self, limits):
+        solenoides_osc.VERBOSO = False
+        self.received = [0]
+        # preparar() maps the module-level handlers, so count them there
+        for name, handler in SOLENOID_HANDLERS.items():
+            setattr(solenoides_osc, name, count_calls(handler, self.received))
+        disp = solenoides_osc.preparar("simulado")
+        if not limits:
+            solenoides_osc.planificador.limites = {}
+        self.backend = solenoides_osc.backend
+        self.port = free_port()
+        self.server = osc_server.BlockingOSCUDPServer(("127.0.0.1", self.port), disp)
+        self.server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, dmx.RECV_BUFFER)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        time.sleep(0.1)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        time.sleep(2 * HIT)  # Let the last pulses finish
+        solenoides_osc.planificador.detener()
+
+    def latencies(self, sends, probes):
+        """Send-to-edge latency: first rising edge on each hit's first coil after the send."""
+        rising = {}
+        for when, pin, level in self.backend.flancos:
+            if level == solenoides_osc.ALTO:
+                rising.setdefault(pin, []).append(when)
+        result, lost = [], 0
+        for sent, coils in zip(sends, probes):
+            edges = rising.get(solenoides_osc.solenoide_pines[COILS[coils[0]]], [])
+            k = bisect.bisect_left(edges, sent)
+            if k < len(edges):
+                result.append(edges[k] - sent)
+            else:
+                lost += 1
+        return result, lost
+
+
+# ------------------- Runner -------------------
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(target, pattern, rate, seconds, mode="thread", refresh_rate=44, limits=False, seed=1):
+    count = int(rate * seconds)
+    probes = [probe for _, probe in traffic(target, pattern, count, seed)]
+    server = DMXUnderTest(mode, refresh_rate) if target == "dmx" else SolenoidsUnderTest(limits)
+    if target == "dmx":
+        per_packet = len(probes[0])
+    else:
+        per_packet = 1 if pattern == "chords" else 2
+
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=sender,
+                                      args=(server.port, target, pattern, rate, count, seed, child))
+    cpu_start = time.process_time()
+    process.start()
+    sends = parent.recv()
+    process.join()
+    time.sleep(0.2 if target == "solenoides" else 3.0 / refresh_rate)  # Drain the last frames/edges
+    cpu = time.process_time() - cpu_start
+    server.stop()
+
+    elapsed = sends[-1] - sends[0] if len(sends) > 1 else float("nan")
+    sent_messages = count * per_packet
+    latencies, lost = server.latencies(sends, probes)
+    label = f"{target}{'/' + mode if target == 'dmx' else ''}"
+    print(f"{label:<14} {pattern:<7} {rate:>7.0f} {count / elapsed:>9.0f} {sent_messages:>8} "
+          f"{sent_messages - server.received[0]:>7} {lost:>5} "
+          f"{percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f} "
+          f"{(max(latencies) if latencies else float('nan')) * 1000:>8.2f} "
+          f"{cpu / max(server.received[0], 1) * 1e6:>9.1f}")
+
+
+def header():
+    print(f"{'target':<14} {'pattern':<7} {'rate':>7} {'pkt/s':>9} {'msgs':>8} {'dropped':>7} {'lost':>5} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'cpu us/msg':>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("target", choices=("dmx", "solenoides", "all"))
+    parser.add_argument("--pattern", choices=PATTERNS, default="sweep")
+    parser.add_argument("--rate", type=float, default=1000, help="OSC packets per second")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--mode", choices=dmx.DMXController.MODES, default="thread", help="dmx.py send mode")
+    parser.add_argument("--refresh-rate", type=float, default=44, help="dmx.py frames per second")
+    parser.add_argument("--limits", action="store_true", help="Keep the solenoid duty-cycle limits on")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    header()
+    if args.target == "all":
+        for mode in dmx.DMXController.MODES:
+            for pattern in PATTERNS:
+                run("dmx", pattern, args.rate, args.seconds, mode, args.refresh_rate, seed=args.seed)
+        for pattern in PATTERNS:
+            run("solenoides", pattern, args.rate, args.seconds, limits=args.limits, seed=args.seed)
+    else:
+        run(args.target, args.pattern, args.rate, args.seconds, args.mode, args.refresh_rate,
+            args.limits, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,108 +1,899 @@
+import argparse
+import asyncio
+import socket
+import struct
+import uuid
 import usb.core
 from pyudmx import pyudmx
-from pythonosc import dispatcher, osc_server
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from pythonosc import dispatcher, osc_message_builder, osc_packet, osc_server
+from threading import RLock, Thread
+from time import monotonic, sleep
 
-class DMXController:
-    def __init__(self):
+RECV_BUFFER = 4 * 1024 * 1024  # Requested SO_RCVBUF for the OSC socket, so bursts aren't dropped by the kernel
+SOURCE_TIMEOUT = 10.0  # Seconds of silence before a merged OSC source (ip:port) is dropped
+
+def dmx_bytes(values):
+    """Return `values` as bytes-like DMX data, clamping sequences of numbers to 0-255."""
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        return values
+    return bytes(max(0, min(255, int(v))) for v in values)
+
+def changed_runs(new, old, start=0, stop=None):
+    """Yield [lo, hi) runs of channels in start..stop where `new` differs from `old`."""
+    stop = len(new) if stop is None else stop
+    channel = start
+    while channel < stop:
+        if new[channel] == old[channel]:
+            channel += 1
+            continue
+        lo = channel
+        while channel < stop and new[channel] != old[channel]:
+            channel += 1
+        yield lo, channel
+
+class Fade:
+    """A linear transition of a channel range from `source` to `target` values."""
+
+    def __init__(self, start, source, target, began, duration):
+        self.start = start
+        self.stop = start + len(target)
+        self.source = bytearray(source)
+        self.target = bytearray(target)
+        self.began = began
+        self.duration = duration
+
+    def values(self, now):
+        """Interpolated values at `now` (fixed-point, so one pass over the range) and whether the fade is done."""
+        k = int(65536 * min(1.0, max(0.0, (now - self.began) / self.duration)))
+        return bytes([a + ((b - a) * k >> 16) for a, b in zip(self.source, self.target)]), k >= 65536
+
+class DMXUniverse:
+    """
+    One DMX universe held in a single bytearray, plus a dirty map with one byte
+    per channel. Writes, clamping and span lookups work on contiguous bytes and
+    never reallocate the buffers.
+    """
+
+    def __init__(self, size=512):
+        self.size = size
+        self.data = bytearray(size)  # Current channel values
+        self.dirty = bytearray(size)  # 1 for channels changed since the last frame
+        self.fades = []  # Running Fade objects, applied in order by step()
+        self._ones = b"\x01" * size
+        self._zeros = bytes(size)
+
+    def set(self, channel, value):
+        """Set one zero-indexed channel, clamping the value to 0-255."""
+        self.data[channel] = max(0, min(255, value))
+        self.dirty[channel] = 1
+        if self.fades:
+            self._pin(channel, channel + 1, self.data[channel:channel + 1])
+
+    def write(self, start, values):
         """
-        Initialize the DMX controller.
-        No channel mapping is predefined; all channels are open for control via OSC.
+        Write a block of values starting at zero-indexed channel `start`.
+        bytes/bytearray/memoryview are copied as-is; other sequences are clamped.
+        Values past the end of the universe are dropped. Returns the stop channel.
         """
-        self.cv = [0 for _ in range(512)]  # List of 512 DMX channels
-        self.dev = pyudmx.uDMXDevice()
-        self.restart_device()
+        stop = min(start + len(values), self.size)
+        count = stop - start
+        values = dmx_bytes(values[:count])
+        self.data[start:stop] = values[:count]
+        self.dirty[start:stop] = self._ones[:count]
+        if self.fades:
+            self._pin(start, stop, self.data[start:stop])
+        return stop
+
+    def fade(self, start, target, duration, now):
+        """
+        Fade channels from zero-indexed `start` towards `target` (bytes) over
+        `duration` seconds, beginning at monotonic time `now`.
+        """
+        stop = min(start + len(target), self.size)
+        target = target[:stop - start]
+        if duration <= 0:
+            self.write(start, target)
+            return
+        self._pin(start, stop, target)
+        self.fades.append(Fade(start, self.data[start:stop], target, now, duration))
+
+    def _pin(self, start, stop, values):
+        """
+        Hold channels start..stop at `values` in every running fade, so the
+        latest write or fade wins on those channels and the rest keep fading.
+        """
+        for fade in self.fades:
+            lo, hi = max(start, fade.start), min(stop, fade.stop)
+            if lo < hi:
+                fade.source[lo - fade.start:hi - fade.start] = values[lo - start:hi - start]
+                fade.target[lo - fade.start:hi - fade.start] = values[lo - start:hi - start]
+
+    def step(self, now):
+        """Advance the running fades to `now`, marking the channels that moved."""
+        running = []
+        for fade in self.fades:
+            values, done = fade.values(now)
+            if values != self.data[fade.start:fade.stop]:
+                self.data[fade.start:fade.stop] = values
+                self.dirty[fade.start:fade.stop] = self._ones[:fade.stop - fade.start]
+            if not done:
+                running.append(fade)
+        self.fades = running
+
+    def view(self, start=0, stop=None):
+        """Zero-copy view of a channel range, e.g. for a fixture patch."""
+        return memoryview(self.data)[start:stop]
+
+    def zero(self):
+        """Set every channel to 0, cancel fades and mark the whole universe dirty."""
+        self.fades = []
+        self.data[:] = self._zeros
+        self.mark_all()
+
+    def mark_all(self):
+        self.dirty[:] = self._ones
+
+    def clear_dirty(self):
+        self.dirty[:] = self._zeros
+
+    def spans(self, max_gap=8):
+        """
+        Group dirty channels into [start, stop) spans.
+        Runs separated by at most max_gap untouched channels are merged, since one
+        slightly longer USB transfer is cheaper than two short ones.
+        """
+        spans = []
+        dirty = self.dirty
+        start = dirty.find(1)
+        while start != -1:
+            stop = dirty.find(0, start)
+            if stop == -1:
+                stop = self.size
+            if spans and start - spans[-1][1] <= max_gap:
+                spans[-1][1] = stop
+            else:
+                spans.append([start, stop])
+            start = dirty.find(1, stop)
+        return spans
+
+class SourceMerge:
+    """
+    Per-source layers for one universe, merged once per frame by
+    Highest-Takes-Precedence ("htp") or Latest-Takes-Precedence ("ltp").
+    Sources that stay silent for `timeout` seconds are dropped and their
+    channels released to the remaining sources.
+    OSC writes only touch the writer's layer; all the per-channel work happens
+    in merge(), so extra sources don't add per-packet cost.
+    Fades and cue crossfades are the FADES source, which never times out.
+    """
+    CHUNK = 32  # merge() compares 32-channel chunks before looking at single channels
+    FADES = "<fades>"  # Source of the controller's fade layer
+
+    def __init__(self, rule="htp", timeout=SOURCE_TIMEOUT, size=512):
+        if rule not in ("htp", "ltp"):
+            raise ValueError(f"Unknown merge rule {rule!r}")
+        self.rule = rule
+        self.timeout = timeout
+        self.size = size
+        self.layers = {}  # Source -> bytearray of its latest values
+        self.touched = {}  # Source -> bytearray, 1 for channels the source has written
+        self.seen = {}  # Source -> monotonic time of its last write
+        self.slots = {}  # Source -> owner id (1-255) used in self.owner for LTP
+        self.owner = bytearray(size)  # LTP: id of the source that wrote each channel last
+        self.merged = bytearray(size)  # Result of the last merge
+        self.applied = bytearray(size)  # What was last written into the universe
+        self.changed = False
+        self._ones = b"\x01" * size
 
-    def restart_device(self):
-        """Open and reset the DMX device."""
+    def write(self, source, start, values, now):
+        """Store bytes from `source` starting at zero-indexed channel `start`."""
+        if source not in self.layers:
+            self.layers[source] = bytearray(self.size)
+            self.touched[source] = bytearray(self.size)
+            if len(self.slots) >= 255:
+                # Owner ids are one byte: make room by dropping the source silent the longest
+                oldest = min((s for s in self.seen if s != self.FADES), key=self.seen.get)
+                print(f"Too many sources, dropping {oldest}.")
+                self.drop(oldest)
+            self.slots[source] = next(i for i in range(1, 256) if i not in self.slots.values())
+        stop = min(start + len(values), self.size)
+        values = values[:stop - start]
+        self.layers[source][start:stop] = values
+        self.touched[source][start:stop] = self._ones[:stop - start]
+        self.seen[source] = now
+        if self.rule == "ltp":
+            self.merged[start:stop] = values
+            self.owner[start:stop] = bytes([self.slots[source]]) * (stop - start)
+        self.changed = True
+
+    def expire(self, now):
+        """Drop sources that timed out; under LTP their channels fall back to the latest remaining writer."""
+        stale = [source for source, seen in self.seen.items()
+                 if now - seen > self.timeout and source != self.FADES]
+        for source in stale:
+            self.drop(source)
+            print(f"Source {source} timed out.")
+
+    def drop(self, source):
+        """Remove a source's layer; under LTP its channels fall back to the latest remaining writer."""
+        slot = self.slots.pop(source)
+        del self.layers[source], self.touched[source], self.seen[source]
+        if self.rule == "ltp":
+            latest = sorted(self.seen, key=self.seen.get, reverse=True)
+            channel = self.owner.find(slot)
+            while channel != -1:
+                fallback = next((s for s in latest if self.touched[s][channel]), None)
+                self.owner[channel] = self.slots[fallback] if fallback is not None else 0
+                self.merged[channel] = self.layers[fallback][channel] if fallback is not None else 0
+                channel = self.owner.find(slot, channel + 1)
+        self.changed = True
+
+    def merge(self, universe, now):
+        """
+        Merge the layers (if anything changed) and write only the channels that
+        moved into `universe`, so fades on the other channels keep running.
+        """
+        if self.timeout is not None:
+            self.expire(now)
+        if not self.changed:
+            return
+        self.changed = False
+        if self.rule == "htp":
+            layers = list(self.layers.values())
+            if len(layers) > 1:
+                self.merged[:] = bytes(map(max, *layers))
+            else:
+                self.merged[:] = layers[0] if layers else bytes(self.size)
+        for start in range(0, self.size, self.CHUNK):
+            stop = start + self.CHUNK
+            if self.merged[start:stop] != self.applied[start:stop]:
+                for lo, hi in changed_runs(self.merged, self.applied, start, stop):
+                    self.applied[lo:hi] = self.merged[lo:hi]
+                    universe.write(lo, self.applied[lo:hi])
+
+class DMXOutput:
+    """
+    Base class for output drivers. An output transmits one universe.
+    Outputs with `partial = True` accept changed spans; the others are always
+    handed the whole frame.
+    """
+    partial = False
+
+    def open(self):
+        pass
+
+    def send(self, start, values):
+        """Transmit `values` (a bytearray) starting at zero-indexed channel `start`."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def reconnect(self):
+        """One reconnection attempt; raises OSError if the output is still unavailable."""
         try:
-            self.dev.open()
-            print(f"DMX Controller initialized. Ready to receive channel values from OSC.")
-        except usb.core.USBError as e:
-            print(f"Error opening DMX device: {e}")
-            self.retry_connection()
+            self.close()
+        except OSError:
+            pass
+        self.open()
+
+class UDMXOutput(DMXOutput):
+    """uDMX USB interface through pyudmx."""
+    partial = True
+
+    def __init__(self):
+        self.dev = pyudmx.uDMXDevice()
+
+    def open(self):
+        """Open the DMX device; the controller retries in the background if it is missing."""
+        if self.dev.open() is False:
+            raise usb.core.USBError("uDMX device not found")
+
+    def send(self, start, values):
+        self.dev.send_multi_value(start + 1, values)
+
+    def close(self):
+        self.dev.close()
+
+class ArtNetOutput(DMXOutput):
+    """Art-Net ArtDmx packets over UDP (broadcast by default)."""
+    HEADER = 18
+
+    def __init__(self, ip="255.255.255.255", universe=0, port=6454):
+        self.address = (ip, port)
+        self.packet = bytearray(self.HEADER + 512)
+        self.packet[:self.HEADER] = (b"Art-Net\x00" + struct.pack("<H", 0x5000)  # OpDmx
+                                     + bytes((0, 14, 0, 0))  # Protocol version 14, sequence, physical
+                                     + struct.pack("<H", universe & 0x7FFF)  # SubUni + Net
+                                     + struct.pack(">H", 512))
+        self.sequence = 0
+        self.sock = None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def send(self, start, values):
+        self.sequence = self.sequence % 255 + 1  # 0 means "sequencing disabled"
+        self.packet[12] = self.sequence
+        self.packet[self.HEADER + start:self.HEADER + start + len(values)] = values
+        self.sock.sendto(self.packet, self.address)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class SACNOutput(DMXOutput):
+    """sACN (ANSI E1.31) data packets, multicast to the universe's group by default."""
+    HEADER = 126
+
+    def __init__(self, universe=1, ip=None, priority=100, source_name="dmx.py", port=5568):
+        self.address = (ip or f"239.255.{universe >> 8 & 0xFF}.{universe & 0xFF}", port)
+        self.packet = bytearray(struct.pack(
+            ">HH12sHI16sHI64sBHBBHHBBHHHB",
+            0x0010, 0, b"ASC-E1.17\x00\x00\x00",  # Root layer preamble, postamble, ACN id
+            0x7000 | 622, 0x00000004, uuid.uuid4().bytes,  # Root flags/length, vector, CID
+            0x7000 | 600, 0x00000002, source_name.encode()[:63],  # Framing flags/length, vector, name
+            priority, 0, 0, 0, universe,  # Priority, sync address, sequence, options, universe
+            0x7000 | 523, 0x02, 0xA1, 0, 1, 513,  # DMP flags/length, vector, types, address, increment, count
+            0,  # DMX start code
+        )) + bytes(512)
+        self.sequence = 0
+        self.sock = None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+
+    def send(self, start, values):
+        self.sequence = (self.sequence + 1) & 0xFF
+        self.packet[111] = self.sequence
+        self.packet[self.HEADER + start:self.HEADER + start + len(values)] = values
+        self.sock.sendto(self.packet, self.address)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class NullOutput(DMXOutput):
+    """Loopback output for testing: keeps the last transmitted frame and counts sends."""
+    partial = True
+
+    def __init__(self, size=512):
+        self.frame = bytearray(size)
+        self.sends = 0
+
+    def send(self, start, values):
+        self.frame[start:start + len(values)] = values
+        self.sends += 1
 
-    def retry_connection(self):
-        """Attempt to reconnect after a delay."""
-        print("Retrying connection in 5 seconds...")
-        sleep(5)
-        self.restart_device()
+def parse_output(spec):
+    """
+    Build an output from a command-line spec:
+    udmx | artnet[:ip[:universe]] | sacn[:universe[:ip]] | null
+    """
+    kind, *params = spec.split(":")
+    if kind == "udmx":
+        return UDMXOutput()
+    if kind == "artnet":
+        return ArtNetOutput(params[0] if params else "255.255.255.255",
+                            int(params[1]) if len(params) > 1 else 0)
+    if kind == "sacn":
+        return SACNOutput(int(params[0]) if params else 1, params[1] if len(params) > 1 else None)
+    if kind == "null":
+        return NullOutput()
+    raise ValueError(f"Unknown output: {spec}")
+
+class DMXController:
+    MODES = ("sync", "thread", "asyncio")
+
+    def __init__(self, outputs=None, refresh_rate=44, keepalive=1.0, max_spans=4, mode="thread",
+                 merge=None, source_timeout=SOURCE_TIMEOUT, backoff=(0.5, 10.0)):
+        """
+        Initialize the DMX controller.
+        No channel mapping is predefined; all channels are open for control via OSC.
+        `outputs` maps universe numbers to output drivers (a single uDMX on
+        universe 1 by default); each universe gets its own buffer.
+        `mode` selects how frames are emitted:
+          - "thread": OSC handlers only write into the channel buffers; one sender
+            thread emits a frame for every universe each 1/refresh_rate seconds
+            (e.g. 30 or 44 Hz).
+          - "sync": changes are sent from the OSC thread right after each packet.
+          - "asyncio": like "thread", but frames are clocked by async_sender_loop
+            on the event loop and output writes run in an executor thread.
+        Each frame only carries the changed span(s); a full 512-channel frame is
+        sent every `keepalive` seconds, or when more than `max_spans` spans changed.
+        Fades and cue crossfades are advanced once per frame, so in "sync" mode
+        they only move when OSC packets arrive.
+        With `merge` set to "htp" or "ltp", every OSC source (the sender's ip:port,
+        or the tag given by a /source message earlier in the same packet) gets its
+        own layer, and the layers are merged once per frame; sources silent for
+        `source_timeout` seconds are dropped (None keeps them forever). Fades and
+        cues then run in a layer of their own (SourceMerge.FADES), merged like any
+        other source. Without `merge`, the last write wins.
+        When an output fails it is reopened from a background thread, waiting
+        between attempts from backoff[0] up to backoff[1] seconds (doubling each
+        time), while OSC keeps updating the buffers; on reconnect the whole
+        universe goes out in the next frame.
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {self.MODES}")
+        self.mode = mode
+        self.outputs = outputs if outputs is not None else {1: UDMXOutput()}
+        self.universes = {number: DMXUniverse() for number in self.outputs}
+        self.frames = {number: bytearray(512) for number in self.outputs}  # Sender-side copies of full frames
+        self.cues = {}  # Cue name -> {universe number: bytes}
+        self.merges = {number: SourceMerge(merge, source_timeout) for number in self.outputs} if merge else {}
+        # With merge, fades and cues run here and reach the universe through merges[number]
+        self.fade_layers = {number: DMXUniverse() for number in self.merges}
+        self.source = None  # Source of the OSC packet being applied (set by FrameDispatcher)
+        self.default_universe = next(iter(self.outputs))  # Target of plain /dmxN messages
+        # Guards self.universes between the OSC and sender threads. The sender only
+        # holds it while copying changes out, never while talking to an output.
+        self.lock = RLock()
+        self.next_refresh = dict.fromkeys(self.outputs, 0.0)  # Next full-frame keepalive per universe
+        self.frame_period = 1.0 / refresh_rate
+        self.keepalive = keepalive
+        self.max_spans = max_spans
+        self.backoff = backoff
+        self.down = {}  # Universe number -> monotonic time its output went down
+        self.retry_delay = {}  # Universe number -> backoff owed until a send confirms the last reconnect
+        self.metrics = {number: {"frames_sent": 0, "frames_dropped": 0, "errors": 0,
+                                 "reconnects": 0, "last_reconnect_s": None}
+                        for number in self.outputs}
+        self.running = True
+        for number, output in self.outputs.items():
+            try:
+                output.open()
+            except OSError as e:
+                print(f"Error opening output for universe {number}: {e}")
+                self.start_reconnect(number)
+        print(f"DMX Controller initialized with universes {list(self.outputs)}. Ready to receive channel values from OSC.")
+        self.sender_thread = None
+        if mode == "thread":
+            self.sender_thread = Thread(target=self.sender_loop, daemon=True)
+            self.sender_thread.start()
 
-    def set_channel_value(self, channel, value):
+    def set_channel_value(self, channel, value, universe=None):
         """
         Set the value of a specific DMX channel.
         Ensures the value is within the allowed range (0-255).
         """
-        if 0 <= channel < 512:
-            # Ensure value is between 0 and 255
-            value = max(0, min(255, value))
-            self.cv[channel] = value
+        number = self.default_universe if universe is None else universe
+        if number not in self.universes:
+            print(f"Unknown universe {universe}.")
+        elif 0 <= channel < 512:
+            with self.lock:
+                if self.merges:
+                    self.merges[number].write(self.source, channel, dmx_bytes((value,)), monotonic())
+                else:
+                    self.universes[number].set(channel, value)
             #print(f"Set channel {channel+1} to {value}.")
         else:
             print(f"Channel {channel+1} out of range (0-511).")
 
-    def send_dmx(self):
+    def send_dmx(self, universe, values, start=0):
         """
-        Send the current DMX values to the lights with a slight delay.
+        Send DMX values to a universe's output starting at zero-indexed channel `start`.
+        Values should be a bytearray, which pyudmx passes to USB without copying.
         """
         try:
-            self.dev.send_multi_value(1, self.cv)
-            sleep(0.05)  # Adding a 50ms delay between each message to reduce data traffic issues
-        except usb.core.USBError as e:
-            print(f"USB Error while sending DMX data: {e}")
-            self.retry_connection()
+            self.outputs[universe].send(start, values)
+            if self.retry_delay:
+                self.retry_delay.pop(universe, None)  # The output really works again
+            return True
+        except OSError as e:  # usb.core.USBError and socket errors
+            print(f"Output error on universe {universe}: {e}")
         except ValueError as e:
             print(f"Value error: {e}. Resetting DMX values and restarting...")
-            self.reset()
-            self.retry_connection()
+            with self.lock:
+                self.universes[universe].zero()
+        self.metrics[universe]["errors"] += 1
+        self.start_reconnect(universe)
+        return False
+
+    def start_reconnect(self, universe):
+        """Take a universe's output offline and start reopening it in the background."""
+        if universe in self.down:
+            return
+        self.down[universe] = monotonic()
+        Thread(target=self.reconnect_loop, args=(universe,), daemon=True).start()
+
+    def reconnect_loop(self, universe):
+        """
+        Retry the output with exponential backoff, then push its full current state.
+        Opening a network output always succeeds, so a reconnect only counts once a
+        send goes through; until then the backoff keeps growing across failures.
+        """
+        delay, max_delay = self.backoff
+        if universe in self.retry_delay:
+            delay = self.retry_delay[universe]
+            sleep(delay)
+            delay = min(delay * 2, max_delay)
+        while self.running:
+            try:
+                self.outputs[universe].reconnect()
+                break
+            except OSError as e:
+                print(f"Reconnect of universe {universe} failed: {e}. Retrying in {delay:.1f} s...")
+                sleep(delay)
+                delay = min(delay * 2, max_delay)
+        else:
+            return
+        with self.lock:
+            self.retry_delay[universe] = delay
+            self.universes[universe].mark_all()  # Latest state goes out whole in the next frame
+            metrics = self.metrics[universe]
+            metrics["reconnects"] += 1
+            metrics["last_reconnect_s"] = round(monotonic() - self.down.pop(universe), 3)
+        print(f"Universe {universe} reconnected after {metrics['last_reconnect_s']} s "
+              f"({metrics['frames_dropped']} frames dropped so far).")
+        if self.mode == "sync":
+            self.flush()  # No sender loop in sync mode: push the latest state now
+
+    def collect_packets(self, now):
+        """
+        Take the changed spans (or full frames) of every universe and clear
+        their dirty maps. Returns a list of (universe, start, values).
+        """
+        packets = []
+        with self.lock:
+            for number, universe in self.universes.items():
+                if self.merges:
+                    self.feed_fade_layer(number, now)
+                    self.merges[number].merge(universe, now)
+                if universe.fades:
+                    universe.step(now)
+                spans = universe.spans()
+                if (now >= self.next_refresh[number] or len(spans) > self.max_spans
+                        or (spans and not self.outputs[number].partial)):
+                    frame = self.frames[number]
+                    frame[:] = universe.data  # In-place copy, no allocation
+                    packets.append((number, 0, frame))
+                    self.next_refresh[number] = now + self.keepalive
+                else:
+                    packets.extend((number, start, universe.data[start:stop]) for start, stop in spans)
+                universe.clear_dirty()
+        return packets
+
+    def feed_fade_layer(self, number, now):
+        """Advance the universe's fade layer and pass the channels that moved to its merge."""
+        layer, merge = self.fade_layers[number], self.merges[number]
+        if layer.fades:
+            layer.step(now)
+        if layer.dirty.find(1) == -1:
+            return
+        written = merge.layers.get(merge.FADES, bytes(merge.size))
+        for start, stop in layer.spans(max_gap=0):
+            for lo, hi in changed_runs(layer.data, written, start, stop):
+                merge.write(merge.FADES, lo, layer.data[lo:hi], now)
+        layer.clear_dirty()
+
+    def fade_target(self, number, start, stop):
+        """
+        Buffer that fades and cues on universe `number` run in: the universe
+        itself, or its fade layer under merge. Under LTP the fade layer first
+        takes over channels start..stop at their current values, so the fade
+        starts from what is on stage and holds channels it doesn't move.
+        """
+        if not self.merges:
+            return self.universes.get(number)
+        layer = self.fade_layers.get(number)
+        if layer is not None and self.merges[number].rule == "ltp":
+            merge = self.merges[number]
+            layer.write(start, merge.merged[start:stop])
+            merge.write(merge.FADES, start, layer.data[start:stop], monotonic())
+        return layer
+
+    def send_packets(self, packets):
+        """Send collected packets, dropping (and counting) frames for outputs that are down."""
+        failed = set()
+        for number, start, values in packets:
+            if number in self.down or number in failed or not self.send_dmx(number, values, start):
+                failed.add(number)
+        for number in {number for number, _, _ in packets}:
+            self.metrics[number]["frames_dropped" if number in failed else "frames_sent"] += 1
+
+    def flush(self):
+        """Send whatever changed since the last frame right away."""
+        self.send_packets(self.collect_packets(monotonic()))
+
+    def sender_loop(self):
+        """
+        Emit at most one frame per universe per period. Every OSC update that
+        lands within a period is coalesced into the next frame, so latency from
+        OSC to light is bounded by one frame period no matter how fast messages arrive.
+        """
+        next_frame = monotonic()
+        while self.running:
+            self.send_packets(self.collect_packets(next_frame))
+            next_frame += self.frame_period
+            delay = next_frame - monotonic()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next_frame = monotonic()  # Fell behind (e.g. USB stall): don't burst to catch up
+
+    async def async_sender_loop(self):
+        """
+        Asyncio version of sender_loop. Changes are collected on the event loop;
+        the (blocking) output writes go to a single worker thread, so receiving
+        and parsing OSC never wait on USB.
+        """
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_frame = monotonic()
+            while self.running:
+                packets = self.collect_packets(next_frame)
+                if packets:
+                    await loop.run_in_executor(executor, self.send_packets, packets)
+                next_frame += self.frame_period
+                delay = next_frame - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    next_frame = monotonic()
+
+    def parse_address(self, address):
+        """Split "/dmxN" or "/uU/dmxN" into (universe number, remaining address parts)."""
+        parts = address.strip("/").split("/")
+        if len(parts) > 1 and parts[0][:1] == "u" and parts[0][1:].isdigit():
+            return int(parts[0][1:]), parts[1:]
+        return self.default_universe, parts
 
     def update_from_osc(self, unused_addr, *args):
         """
         OSC callback to update DMX channels.
-        This function extracts the DMX channel from the OSC address.
+        This function extracts the universe and DMX channel from the OSC address
+        ("/dmx1" for the default universe, "/u2/dmx1" for universe 2).
         """
-        osc_address = unused_addr.split('/')[-1]  # Extract the last part of the OSC address, e.g., "dmx1"
+        universe, parts = self.parse_address(unused_addr)
+        osc_address = parts[-1]  # Extract the last part of the OSC address, e.g., "dmx1"
         if osc_address.startswith('dmx') and osc_address[3:].isdigit():
             channel = int(osc_address[3:]) - 1  # Extract the number from the address and convert to zero-indexed
             value = int(args[0])  # The value should be the first argument
             #print(f"Received OSC message: Address: {unused_addr}, Value: {value}")
-            self.set_channel_value(channel, value)
-            self.send_dmx()
+            self.set_channel_value(channel, value, universe)
         else:
             print(f"Invalid OSC address: {unused_addr}")
 
+    def update_block_from_osc(self, unused_addr, *args):
+        """
+        OSC callback for /dmx/block <start> <blob | int ...> (or /uU/dmx/block).
+        Writes a whole range of channels beginning at 1-indexed channel `start`,
+        so a full-universe scene change is one datagram and one USB transfer.
+        """
+        number, _ = self.parse_address(unused_addr)
+        if number not in self.universes or len(args) < 2:
+            print(f"Invalid OSC block message: {unused_addr} {args}")
+            return
+        start = int(args[0]) - 1
+        values = dmx_bytes(args[1] if isinstance(args[1], bytes) else args[1:])  # Blob or int list
+        if 0 <= start < 512:
+            with self.lock:
+                if self.merges:
+                    self.merges[number].write(self.source, start, values, monotonic())
+                else:
+                    self.universes[number].write(start, values)
+        else:
+            print(f"Channel {start+1} out of range (0-511).")
+
+    def fade_from_osc(self, unused_addr, *args):
+        """
+        OSC callback for /fade <first> <last> <target> <ms> (or /uU/fade).
+        Fades 1-indexed channels first..last to `target` over `ms` milliseconds.
+        """
+        number, _ = self.parse_address(unused_addr)
+        if number not in self.universes or len(args) < 4:
+            print(f"Invalid OSC fade message: {unused_addr} {args}")
+            return
+        first, last = int(args[0]) - 1, int(args[1])
+        if not 0 <= first < last <= 512:
+            print(f"Invalid channel range {first+1}-{last}.")
+            return
+        value = max(0, min(255, int(args[2])))
+        with self.lock:
+            target = self.fade_target(number, first, last)
+            target.fade(first, bytes([value]) * (last - first), float(args[3]) / 1000, monotonic())
+
+    def store_cue(self, name):
+        """Snapshot every universe as cue `name`."""
+        with self.lock:
+            self.cues[name] = {number: bytes(universe.data) for number, universe in self.universes.items()}
+
+    def recall_cue(self, name, seconds=0.0, start_from=None):
+        """
+        Crossfade from the current look (or from cue `start_from`) to cue `name`
+        over `seconds`. Under merge the crossfade runs in the fade layer.
+        """
+        cue = self.cues.get(name)
+        origin = self.cues.get(start_from) if start_from is not None else {}
+        if cue is None or origin is None:
+            print(f"Unknown cue: {name if cue is None else start_from}")
+            return
+        now = monotonic()
+        with self.lock:
+            for number, values in cue.items():
+                if number not in self.universes:
+                    continue
+                universe = self.fade_target(number, 0, len(values))
+                if number in origin:
+                    universe.write(0, origin[number])
+                universe.fade(0, values, seconds, now)
+
+    def cue_from_osc(self, unused_addr, *args):
+        """
+        OSC callback for cues:
+          /cue/store <name>
+          /cue/recall <name> [ms]       crossfade from the current look
+          /cue/xfade <from> <to> <ms>   crossfade between two stored cues
+        """
+        action = unused_addr.strip("/").split("/")[-1]
+        if action == "store" and args:
+            self.store_cue(str(args[0]))
+        elif action == "recall" and args:
+            self.recall_cue(str(args[0]), float(args[1]) / 1000 if len(args) > 1 else 0.0)
+        elif action == "xfade" and len(args) >= 3:
+            self.recall_cue(str(args[1]), float(args[2]) / 1000, start_from=str(args[0]))
+        else:
+            print(f"Invalid OSC cue message: {unused_addr} {args}")
+
+    def metrics_from_osc(self, unused_addr, *args):
+        """
+        OSC callback for /dmx/metrics [universe]. Replies to the sender with
+        /dmx/metrics <universe> <frames sent> <frames dropped> <errors> <reconnects> <last reconnect s>.
+        """
+        number = int(args[0]) if args else self.default_universe
+        metrics = self.metrics.get(number)
+        if metrics is None:
+            print(f"Unknown universe {number}.")
+            return None
+        return ("/dmx/metrics", number, metrics["frames_sent"], metrics["frames_dropped"], metrics["errors"],
+                metrics["reconnects"], float(metrics["last_reconnect_s"] or 0.0))
+
+    def source_from_osc(self, unused_addr, *args):
+        """OSC callback for /source <tag>: name the source of the rest of this packet."""
+        if args:
+            self.source = str(args[0])
+
     def reset(self):
         """
         Reset all channels (turn off the lights).
         """
-        self.cv = [0 for _ in range(512)]
+        self.running = False
+        if self.sender_thread is not None:
+            self.sender_thread.join()
+        for number, output in self.outputs.items():
+            self.universes[number].zero()
+            try:
+                if number not in self.down:
+                    output.send(0, self.universes[number].data)
+                output.close()
+            except OSError as e:
+                print(f"Output error while resetting universe {number}: {e}")
+            print(f"Universe {number} metrics: {self.metrics[number]}")
+        print("All channels reset and DMX closed.")
+
+class FrameDispatcher(dispatcher.Dispatcher):
+    """
+    Dispatcher that applies every message of a packet under the controller lock,
+    so all the messages of an OSC bundle land in the same DMX frame.
+    The packet's sender address is the default source for HTP/LTP merging.
+    In "sync" mode the changes are sent once the whole packet is applied.
+    Bundle timetags are ignored: DMX updates apply as soon as the packet arrives.
+    Handler return values are sent back to the client as OSC replies.
+    """
+
+    def __init__(self, controller):
+        super().__init__()
+        self.controller = controller
+
+    def call_handlers_for_packet(self, data, client_address):
         try:
-            self.send_dmx()
-        except usb.core.USBError as e:
-            print(f"USB Error while resetting DMX: {e}")
-        finally:
-            self.dev.close()
-            print("All channels reset and DMX closed.")
+            packet = osc_packet.OscPacket(data)
+        except osc_packet.ParseError:
+            return []
+        results = []
+        with self.controller.lock:
+            self.controller.source = f"{client_address[0]}:{client_address[1]}"
+            for timed_msg in packet.messages:
+                for handler in self.handlers_for_address(timed_msg.message.address):
+                    result = handler.invoke(client_address, timed_msg.message)
+                    if result is not None:
+                        results.append(result)
+        if self.controller.mode == "sync":
+            self.controller.flush()
+        return results
+
+class OSCDatagramProtocol(asyncio.DatagramProtocol):
+    """Hands every datagram straight to the dispatcher on the event loop."""
+
+    def __init__(self, disp):
+        self.dispatcher = disp
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        for reply in self.dispatcher.call_handlers_for_packet(data, addr):
+            self.transport.sendto(osc_message_builder.build_msg(reply[0], reply[1:]).dgram, addr)
+
+def make_dispatcher(dmx_controller):
+    disp = FrameDispatcher(dmx_controller)
+    disp.map("/dmx[0-9]*", dmx_controller.update_from_osc)  # Map /dmx1 ... /dmx512 (but not /dmx/block)
+    disp.map("/dmx/block", dmx_controller.update_block_from_osc)
+    disp.map("/u[0-9]*/dmx[0-9]*", dmx_controller.update_from_osc)  # Same, for universe U
+    disp.map("/u[0-9]*/dmx/block", dmx_controller.update_block_from_osc)
+    disp.map("/dmx/metrics", dmx_controller.metrics_from_osc)
+    disp.map("/source", dmx_controller.source_from_osc)
+    disp.map("/fade", dmx_controller.fade_from_osc)
+    disp.map("/u[0-9]*/fade", dmx_controller.fade_from_osc)
+    disp.map("/cue/store", dmx_controller.cue_from_osc)
+    disp.map("/cue/recall", dmx_controller.cue_from_osc)
+    disp.map("/cue/xfade", dmx_controller.cue_from_osc)
+    return disp
 
 def start_osc_server(dmx_controller, ip='127.0.0.1', port=8000):
     """
     Start an OSC server to receive DMX channel updates.
     """
-    disp = dispatcher.Dispatcher()
-    disp.map("/dmx*", dmx_controller.update_from_osc)  # Map all addresses starting with "/dmx"
-    
-    server = osc_server.BlockingOSCUDPServer((ip, port), disp)
+    server = osc_server.BlockingOSCUDPServer((ip, port), make_dispatcher(dmx_controller))
+    server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
     print(f"OSC server running on {ip}:{port}")
     server.serve_forever()
 
-if __name__ == "__main__":
-    dmx = DMXController()
+async def serve_asyncio(dmx_controller, ip='127.0.0.1', port=8000):
+    """
+    Receive OSC on the event loop and emit frames from async_sender_loop
+    (for controllers created with mode="asyncio").
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+    sock.bind((ip, port))
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: OSCDatagramProtocol(make_dispatcher(dmx_controller)), sock=sock)
+    print(f"OSC server (asyncio) running on {ip}:{port}")
+    try:
+        await dmx_controller.async_sender_loop()
+    finally:
+        transport.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OSC to DMX bridge.")
+    parser.add_argument("--ip", default="127.0.0.1", help="OSC listen address")
+    parser.add_argument("--port", type=int, default=8000, help="OSC listen port")
+    parser.add_argument("--rate", type=float, default=44, help="DMX frames per second")
+    parser.add_argument("--mode", choices=DMXController.MODES, default="thread",
+                        help="thread: fixed-rate sender thread; sync: send from the OSC thread after each packet; "
+                             "asyncio: event-loop server with fixed-rate frames")
+    parser.add_argument("--merge", choices=("htp", "ltp"),
+                        help="Merge OSC sources per frame by Highest or Latest Takes Precedence")
+    parser.add_argument("--source-timeout", type=float, default=SOURCE_TIMEOUT,
+                        help="Seconds of silence after which a merged source is dropped "
+                             f"(default {SOURCE_TIMEOUT}; 0 keeps sources forever)")
+    parser.add_argument("--output", action="append", metavar="SPEC",
+                        help="Output for the next universe (1, 2, ...): udmx, artnet[:ip[:universe]], "
+                             "sacn[:universe[:ip]] or null. Default: udmx")
+    args = parser.parse_args(argv)
+    outputs = {number: parse_output(spec) for number, spec in enumerate(args.output or ["udmx"], start=1)}
+    dmx = DMXController(outputs, refresh_rate=args.rate, mode=args.mode,
+                        merge=args.merge, source_timeout=args.source_timeout or None)
 
     try:
         # Start OSC server to receive DMX data
-        start_osc_server(dmx)
+        if args.mode == "asyncio":
+            asyncio.run(serve_asyncio(dmx, args.ip, args.port))
+        else:
+            start_osc_server(dmx, args.ip, args.port)
     except KeyboardInterrupt:
         pass
     finally:
         dmx.reset()
         print("Exiting...")
+
+if __name__ == "__main__":
+    main()
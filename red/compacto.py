@@ -0,0 +1,116 @@
+"""
+Formato compacto para los reportes de telemetría ("compacto1").
+
+Al conectar, el cliente manda una línea JSON de saludo con la tabla de campos
+que va a usar, por ejemplo
+    {"hola": 1, "formato": "compacto1", "campos": [["usuario", "s"], ["ram_usada_MB", "I"], ...]}
+y el servidor contesta {"formato": "compacto1"} (o {"formato": "json"} si no
+la acepta). Desde ahí cada reporte es una trama binaria:
+
+    largo   u16 big-endian, bytes que siguen (0 = latido)
+    tipo    u8, 0 = completo, 1 = delta (solo campos que cambiaron)
+    campos  máscara de los campos presentes, 1 bit por campo de la tabla
+    nulos   máscara de los campos presentes que valen None
+    valores los campos presentes y no nulos, en el orden de la tabla
+
+Tipos: "s" texto (u16 largo + UTF-8), "f" float32, "I" u32, "?" bool.
+Los campos anidados se nombran con punto ("servicios.jacktrip").
+"""
+import struct
+
+VERSION = "compacto1"
+COMPLETO = 0
+DELTA = 1
+TIPOS = {"f": struct.Struct("<f"), "I": struct.Struct("<I"), "?": struct.Struct("<?")}
+LARGO = struct.Struct(">H")
+LATIDO = LARGO.pack(0)
+MAX_CAMPOS = 64
+
+
+class Tabla:
+    """Campos negociados para una conexión: lista de (nombre, tipo)."""
+
+    def __init__(self, campos):
+        campos = [(str(nombre), str(tipo)) for nombre, tipo in campos]
+        if not campos or len(campos) > MAX_CAMPOS:
+            raise ValueError(f"La tabla debe tener entre 1 y {MAX_CAMPOS} campos")
+        for nombre, tipo in campos:
+            if tipo != "s" and tipo not in TIPOS:
+                raise ValueError(f"Tipo desconocido {tipo!r} para {nombre}")
+        self.campos = campos
+        self.bytes_mascara = (len(campos) + 7) // 8
+
+    def saludo(self):
+        return {"hola": 1, "formato": VERSION, "campos": [list(campo) for campo in self.campos]}
+
+
+def aplanar(datos, prefijo=""):
+    plano = {}
+    for campo, valor in datos.items():
+        if isinstance(valor, dict):
+            plano.update(aplanar(valor, f"{prefijo}{campo}."))
+        else:
+            plano[prefijo + campo] = valor
+    return plano
+
+
+def anidar(plano):
+    datos = {}
+    for nombre, valor in plano.items():
+        *padres, campo = nombre.split(".")
+        destino = datos
+        for padre in padres:
+            destino = destino.setdefault(padre, {})
+        destino[campo] = valor
+    return datos
+
+
+def codificar(tabla, datos, anterior=None):
+    """
+    Trama (con su largo) para `datos`: completa si no hay `anterior`, si no
+    delta con solo los campos que cambiaron.
+    """
+    plano = aplanar(datos)
+    previo = None if anterior is None else aplanar(anterior)
+    presentes = nulos = 0
+    valores = bytearray()
+    for i, (nombre, tipo) in enumerate(tabla.campos):
+        valor = plano.get(nombre)
+        if previo is not None and previo.get(nombre) == valor:
+            continue
+        presentes |= 1 << i
+        if valor is None:
+            nulos |= 1 << i
+        elif tipo == "s":
+            texto = str(valor).encode("utf-8")
+            valores += LARGO.pack(len(texto)) + texto
+        else:
+            valores += TIPOS[tipo].pack(valor)
+    n = tabla.bytes_mascara
+    cuerpo = (bytes([COMPLETO if previo is None else DELTA]) + presentes.to_bytes(n, "little")
+              + nulos.to_bytes(n, "little") + valores)
+    return LARGO.pack(len(cuerpo)) + cuerpo
+
+
+def decodificar(tabla, cuerpo, anterior=None):
+    """Reporte completo a partir de una trama (sin el largo) y el reporte anterior de la conexión."""
+    n = tabla.bytes_mascara
+    tipo_trama = cuerpo[0]
+    presentes = int.from_bytes(cuerpo[1:1 + n], "little")
+    nulos = int.from_bytes(cuerpo[1 + n:1 + 2 * n], "little")
+    plano = aplanar(anterior) if tipo_trama == DELTA and anterior else {}
+    pos = 1 + 2 * n
+    for i, (nombre, tipo) in enumerate(tabla.campos):
+        if not presentes >> i & 1:
+            continue
+        if nulos >> i & 1:
+            plano[nombre] = None
+        elif tipo == "s":
+            (largo,) = LARGO.unpack_from(cuerpo, pos)
+            plano[nombre] = cuerpo[pos + 2:pos + 2 + largo].decode("utf-8", errors="replace")
+            pos += 2 + largo
+        else:
+            (valor,) = TIPOS[tipo].unpack_from(cuerpo, pos)
+            plano[nombre] = float(f"{valor:.6g}") if tipo == "f" else valor
+            pos += TIPOS[tipo].size
+    return anidar(plano)
@@ -1,15 +1,46 @@
 # corre_servicio.py
 import socket
 import getpass
+import glob
 import psutil
 import time
 import subprocess
 import json
+import os
 import platform
+import select
+
+import compacto
 
 PUERTO_TCP = 5555
 PUERTO_UDP = 5556
-TIEMPO_ESPERA = 10  # segundos entre envíos
+TIEMPO_ESPERA = 1  # segundos entre envíos
+LATIDO = 15  # segundos máximos sin mandar nada por la conexión
+COMPLETO_CADA = 60  # segundos máximos entre reportes completos, por si el servidor descartó algún delta
+REINTENTO_MAX = 30  # segundos máximos entre intentos de reconexión
+CACHE_DESCUBRIMIENTO = 300  # segundos que se reutiliza la IP descubierta del servidor
+ARCHIVO_IP_SERVIDOR = "ip_servidor.txt"
+servidor_cache = {"ip": None, "hasta": 0.0}  # Última IP descubierta y hasta cuándo vale
+INTERVALO_IP = 60  # segundos que se reutiliza la IP local
+INTERVALO_SERVICIOS = 30  # segundos entre consultas a systemctl (solo si no hay cgroups)
+CGROUPS_SISTEMA = ("/sys/fs/cgroup/system.slice", "/sys/fs/cgroup/systemd/system.slice")
+ip_local_cache = {"ip": None, "hasta": 0.0}
+servicio_cache = {"estado": None, "hasta": 0.0}
+sensor_temperatura = None  # Ruta en /sys, (sensor, índice) de psutil, o False si no hay
+datos_fijos = None
+FORMATO = compacto.VERSION  # "json" para no negociar el formato compacto
+ESPERA_NEGOCIACION = 2  # segundos a esperar la respuesta al saludo
+servidores_json = set()  # IPs de servidores que cerraron o contestaron mal al saludo
+CAMPOS_COMPACTOS = [
+    ("usuario", "s"),
+    ("hostname", "s"),
+    ("sistema_operativo", "s"),
+    ("ip_local", "s"),
+    ("temperatura_C", "f"),
+    ("ram_usada_MB", "I"),
+    ("ram_total_MB", "I"),
+    ("servicios.jacktrip", "?"),
+]
 
 def obtener_ip_local():
     try:
@@ -22,54 +53,111 @@ def obtener_ip_local():
         print("No se pudo obtener IP local:", e)
         return "desconocida"
 
-def obtener_temperatura():
+def ip_local_cacheada():
+    ahora = time.monotonic()
+    if ahora >= ip_local_cache["hasta"]:
+        ip_local_cache.update(ip=obtener_ip_local(), hasta=ahora + INTERVALO_IP)
+    return ip_local_cache["ip"]
+
+def buscar_sensor():
+    # Primero un archivo de /sys que se pueda leer directo (Raspberry Pi: thermal_zone0)
+    rutas = sorted(glob.glob("/sys/class/thermal/thermal_zone*/temp")) + \
+        sorted(glob.glob("/sys/class/hwmon/hwmon*/temp*_input"))
+    for ruta in rutas:
+        try:
+            with open(ruta) as f:
+                if int(f.read()) > 0:
+                    return ruta
+        except (OSError, ValueError):
+            continue
+    # Si no, el primer sensor con lectura que encuentre psutil
     try:
-        temps = psutil.sensors_temperatures()
-        if not temps:
-            return None
-        for sensor_name, entradas in temps.items():
-            for entrada in entradas:
+        for sensor_name, entradas in psutil.sensors_temperatures().items():
+            for indice, entrada in enumerate(entradas):
                 if entrada.current:
-                    return entrada.current
+                    return (sensor_name, indice)
+    except:
+        pass
+    return False
+
+def obtener_temperatura():
+    global sensor_temperatura
+    if sensor_temperatura is None:
+        sensor_temperatura = buscar_sensor()
+    try:
+        if isinstance(sensor_temperatura, str):
+            with open(sensor_temperatura) as f:
+                return round(int(f.read()) / 1000, 1)
+        if sensor_temperatura:
+            sensor_name, indice = sensor_temperatura
+            return psutil.sensors_temperatures()[sensor_name][indice].current
     except:
         return None
     return None
 
-def obtener_datos():
-    usuario = getpass.getuser()
-    hostname = socket.gethostname() or platform.node()
-    sistema = platform.system()
-    ip_local = obtener_ip_local()
-    temperatura = obtener_temperatura()
-
-    memoria = psutil.virtual_memory()
-    ram_usada = memoria.used // (1024 * 1024)
-    ram_total = memoria.total // (1024 * 1024)
-
-    jacktrip_activo = None
-    if sistema == "Linux":
+def jacktrip_activo():
+    # Con systemd un servicio activo tiene procesos en su cgroup; leerlo no crea procesos
+    for slice_sistema in CGROUPS_SISTEMA:
+        if os.path.isdir(slice_sistema):
+            try:
+                with open(os.path.join(slice_sistema, "jacktrip.service", "cgroup.procs")) as f:
+                    return bool(f.read().strip())
+            except FileNotFoundError:
+                return False  # systemd borra el cgroup cuando el servicio se detiene
+            except OSError:
+                break
+    # Sin cgroups legibles: preguntar a systemctl, pero no en cada muestra
+    ahora = time.monotonic()
+    if ahora >= servicio_cache["hasta"]:
         try:
             estado = subprocess.run(
                 ["systemctl", "is-active", "--quiet", "jacktrip.service"],
                 check=False
             )
-            jacktrip_activo = estado.returncode == 0
+            servicio_cache["estado"] = estado.returncode == 0
         except:
-            jacktrip_activo = None
+            servicio_cache["estado"] = None
+        servicio_cache["hasta"] = ahora + INTERVALO_SERVICIOS
+    return servicio_cache["estado"]
 
+def obtener_datos_fijos():
+    # Lo que no cambia mientras corre el cliente se calcula una sola vez
+    global datos_fijos
+    if datos_fijos is None:
+        datos_fijos = {
+            "usuario": getpass.getuser(),
+            "hostname": socket.gethostname() or platform.node(),
+            "sistema_operativo": platform.system(),
+            "ram_total_MB": psutil.virtual_memory().total // (1024 * 1024),
+        }
+    return datos_fijos
+
+def obtener_datos():
+    fijos = obtener_datos_fijos()
     return {
-        "usuario": usuario,
-        "hostname": hostname,
-        "sistema_operativo": sistema,
-        "ip_local": ip_local,
-        "temperatura_C": temperatura,
-        "ram_usada_MB": ram_usada,
-        "ram_total_MB": ram_total,
+        "usuario": fijos["usuario"],
+        "hostname": fijos["hostname"],
+        "sistema_operativo": fijos["sistema_operativo"],
+        "ip_local": ip_local_cacheada(),
+        "temperatura_C": obtener_temperatura(),
+        "ram_usada_MB": psutil.virtual_memory().used // (1024 * 1024),
+        "ram_total_MB": fijos["ram_total_MB"],
         "servicios": {
-            "jacktrip": jacktrip_activo
+            "jacktrip": jacktrip_activo() if fijos["sistema_operativo"] == "Linux" else None
         }
     }
 
+def cambios(anterior, actual):
+    """
+    Reporte a enviar: completo si es el primero de la conexión, si no solo los
+    campos que cambiaron, marcado con "delta" para que el servidor los combine.
+    """
+    if anterior is None:
+        return actual
+    delta = {campo: valor for campo, valor in actual.items() if anterior.get(campo) != valor}
+    delta["delta"] = True
+    return delta
+
 def descubrir_servidor(usuario, hostname):
     mensaje = json.dumps({"usuario": usuario, "hostname": hostname})
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
@@ -86,30 +174,153 @@ def descubrir_servidor(usuario, hostname):
             print(f"Error en descubrimiento UDP: {e}")
             return None
 def guarda_ip_servidor(ip_server):
-    with open ("ip_servidor.txt","a") as f:
-        f.write(ip_server)
+    # Una sola línea con la última IP conocida (antes se agregaba sin fin)
+    with open(ARCHIVO_IP_SERVIDOR, "w") as f:
+        f.write(ip_server + "\n")
+
+def lee_ip_servidor():
+    # IP guardada por una ejecución anterior, si todavía no caduca
+    try:
+        if time.time() - os.path.getmtime(ARCHIVO_IP_SERVIDOR) > CACHE_DESCUBRIMIENTO:
+            return None
+        with open(ARCHIVO_IP_SERVIDOR) as f:
+            return f.readline().strip() or None
+    except OSError:
+        return None
+
+def servidor_conocido(usuario, hostname, forzar=False):
+    """
+    Devuelve la IP del servidor sin descubrirla de nuevo mientras no caduque
+    (CACHE_DESCUBRIMIENTO) o hasta que conectar con ella falle (forzar).
+    """
+    ahora = time.monotonic()
+    if not forzar:
+        if servidor_cache["ip"] and ahora < servidor_cache["hasta"]:
+            return servidor_cache["ip"]
+        ip = lee_ip_servidor()
+        if ip:
+            servidor_cache.update(ip=ip, hasta=ahora + CACHE_DESCUBRIMIENTO)
+            return ip
+    ip = descubrir_servidor(usuario, hostname)
+    if ip:
+        if ip != servidor_cache["ip"]:
+            guarda_ip_servidor(ip)
+        servidor_cache.update(ip=ip, hasta=ahora + CACHE_DESCUBRIMIENTO)
+    return ip
+
+def conectar(servidor_ip):
+    s = socket.create_connection((servidor_ip, PUERTO_TCP), timeout=5)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return s
+
+def conexion_viva(s):
+    # El servidor no manda nada; si el socket se vuelve legible es que cerró
+    legibles, _, _ = select.select([s], [], [], 0)
+    if not legibles:
+        return True
+    try:
+        return s.recv(1, socket.MSG_PEEK) != b""
+    except OSError:
+        return False
+
+def negociar(s):
+    """
+    Propone el formato compacto con la tabla CAMPOS_COMPACTOS. Devuelve la
+    Tabla si el servidor la acepta, o None para seguir con JSON (también si
+    el servidor no contesta, como los servidores viejos). Si el servidor
+    cierra o contesta algo que no es JSON, lanza OSError o ValueError.
+    """
+    if FORMATO != compacto.VERSION:
+        return None
+    tabla = compacto.Tabla(CAMPOS_COMPACTOS)
+    s.sendall((json.dumps(tabla.saludo()) + "\n").encode())
+    respuesta = b""
+    s.settimeout(ESPERA_NEGOCIACION)
+    try:
+        while not respuesta.endswith(b"\n"):
+            chunk = s.recv(256)
+            if not chunk:
+                raise ConnectionError("El servidor cerró la conexión")
+            respuesta += chunk
+    except socket.timeout:
+        return None
+    finally:
+        s.settimeout(5)
+    try:
+        formato = json.loads(respuesta).get("formato")
+    except (ValueError, AttributeError):
+        raise ValueError(f"Respuesta inválida al saludo: {respuesta[:60]!r}")
+    return tabla if formato == compacto.VERSION else None
+
+def esperar_con_latidos(s, segundos, latido=b"\n"):
+    # Si hay que esperar más que LATIDO, manda latidos para que el servidor no cierre
+    fin = time.monotonic() + segundos
+    while True:
+        restante = fin - time.monotonic()
+        if restante <= 0:
+            return
+        time.sleep(min(restante, LATIDO))
+        if fin - time.monotonic() > 0:
+            s.sendall(latido)
+
 def enviar_datos():
     usuario = getpass.getuser()
     hostname = socket.gethostname() or platform.node()
+    conexion = None
+    tabla = None  # compacto.Tabla negociada, o None si la conexión usa JSON
+    ultimo = None  # Último reporte completo enviado por esta conexión
+    proximo_completo = 0.0  # Hora (monotonic) a partir de la cual se manda un reporte completo
+    espera = 1
+    fallos = 0  # Intentos de conexión fallidos seguidos; tras uno se vuelve a descubrir
     while True:
-        servidor_ip = descubrir_servidor(usuario, hostname)
-        guarda_ip_servidor(servidor_ip)
-        if servidor_ip:
-            datos = obtener_datos()
-            print("\nDatos preparados para enviar:")
-            print(json.dumps(datos, indent=2))
-
+        if conexion is None:
+            servidor_ip = servidor_conocido(usuario, hostname, forzar=fallos > 0)
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((servidor_ip, PUERTO_TCP))
-                    s.sendall(json.dumps(datos).encode())
-                    print(f"Datos enviados correctamente a {servidor_ip}")
-            except Exception as e:
-                print("Error al enviar datos:", e)
-        else:
-            print("No se encontró el servidor. Reintentando...")
-
-        time.sleep(TIEMPO_ESPERA)
+                if not servidor_ip:
+                    raise ConnectionError("No se encontró el servidor")
+                nueva = conectar(servidor_ip)
+                if servidor_ip in servidores_json:
+                    tabla = None
+                else:
+                    try:
+                        tabla = negociar(nueva)
+                    except (OSError, ValueError) as e:
+                        # Servidor viejo que no entiende el saludo: reconectar ya, sin negociar
+                        nueva.close()
+                        servidores_json.add(servidor_ip)
+                        print(f"{servidor_ip} no aceptó el saludo ({e}), se usará JSON.")
+                        continue
+                conexion = nueva
+                formato = compacto.VERSION if tabla else "json"
+                print(f"Conectado a {servidor_ip} ({formato}), enviando datos cada {TIEMPO_ESPERA} s")
+                espera = 1
+                fallos = 0
+            except (OSError, ValueError) as e:
+                fallos += 1
+                print(f"{e}. Reintentando en {espera} s...")
+                time.sleep(espera)
+                espera = min(espera * 2, REINTENTO_MAX)
+                continue
+
+        datos = obtener_datos()
+        try:
+            if not conexion_viva(conexion):
+                raise ConnectionError("El servidor cerró la conexión")
+            anterior = ultimo if time.monotonic() < proximo_completo else None
+            if tabla:
+                conexion.sendall(compacto.codificar(tabla, datos, anterior))
+            else:
+                conexion.sendall((json.dumps(cambios(anterior, datos)) + "\n").encode())
+            if anterior is None:
+                proximo_completo = time.monotonic() + COMPLETO_CADA
+            ultimo = datos
+            esperar_con_latidos(conexion, TIEMPO_ESPERA, compacto.LATIDO if tabla else b"\n")
+        except OSError as e:
+            print("Conexión perdida:", e)
+            conexion.close()
+            conexion = None
+            ultimo = None  # La nueva conexión empieza con un reporte completo
 
 if __name__ == "__main__":
     enviar_datos()
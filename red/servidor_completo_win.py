@@ -1,15 +1,32 @@
+import asyncio
 import socket
 import json
+import queue
 import threading
 import os
 import csv
 import re
+import time
 from datetime import datetime
 
+import compacto
+from telemetria import AlmacenTelemetria
+
 PUERTO_TCP = 5555
 PUERTO_UDP = 5556
-BUFFER_SIZE = 4096
+TIEMPO_LECTURA = 60  # segundos sin datos antes de cerrar una conexión
+MAX_REPORTE = 64 * 1024  # bytes máximos por reporte (una línea JSON)
 usuarios_conectados = {}
+cola_reportes = queue.Queue()  # ((ip, puerto), hora, línea o trama, tabla) pendientes de procesar
+MAX_COLA = 10000  # reportes en cola a partir de los cuales se descartan (los cierres nunca)
+reportes_descartados = 0
+TTL_IP_LOCAL = 60  # segundos que se reutiliza la IP local en las respuestas UDP
+respuesta_cache = {"datos": b"", "hasta": 0.0}
+historial = None  # AlmacenTelemetria; se abre en el arranque
+INTERVALO_CSV = 1.0  # segundos entre escrituras de los CSV de usuarios
+ips_usuarios = {}  # ruta del CSV -> IP que debe tener en la celda [0,0]
+csv_pendientes = set()  # rutas cuya IP cambió y falta escribir
+lock_csv = threading.Lock()
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -37,104 +54,274 @@ def _safe_filename_from_user(user: str) -> str:
     return f"{name}.csv"
 
 
-def guardar_ip_en_csv(usuario: str, ip: str) -> None:
+def leer_csv(ruta: str) -> list:
+    """Filas del CSV, o [[""]] si no existe o está vacío."""
+    filas = []
+    if os.path.exists(ruta):
+        with open(ruta, "r", encoding="utf-8", newline="") as f:
+            filas = list(csv.reader(f))
+    if not filas:
+        filas = [[""]]
+    if not filas[0]:
+        filas[0] = [""]
+    return filas
+
+
+def guardar_ip_en_csv(ruta: str, ip: str) -> None:
     """
-    Crea/actualiza un CSV llamado <usuario>.csv en el mismo directorio
-    y coloca la IP en la celda [0,0].
+    Coloca la IP en la celda [0,0] del CSV, conservando el resto. Escribe a un
+    temporal y lo renombra, para que un patch que lea el archivo nunca lo vea a medias.
     """
-    try:
-        ruta = os.path.join(BASE_DIR, _safe_filename_from_user(usuario))
-        filas = []
-        if os.path.exists(ruta):
-            with open(ruta, "r", encoding="utf-8", newline="") as f:
-                filas = list(csv.reader(f))
-        if not filas:
-            filas = [[""]]
-        if not filas[0]:
-            filas[0] = [""]
-        filas[0][0] = ip
-        with open(ruta, "w", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerows(filas)
-        print(f"[CSV] Guardada IP {ip} en {ruta} (celda [0,0])")
-    except Exception as e:
-        print(f"[CSV]  Error al guardar CSV: {e}")
-
-
-def recv_json_lines(conn):
-    """Lee del socket hasta encontrar un \\n y devuelve un dict (JSON por línea)."""
-    buf = b""
+    filas = leer_csv(ruta)
+    filas[0][0] = ip
+    temporal = ruta + ".tmp"
+    with open(temporal, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerows(filas)
+    os.replace(temporal, ruta)
+    print(f"[CSV] Guardada IP {ip} en {ruta} (celda [0,0])")
+
+
+def registrar_ip(usuario: str, ip: str) -> None:
+    """
+    Anota la IP del usuario en memoria; el CSV <usuario>.csv se escribe después,
+    en escribir_csv_pendientes, y solo si la IP cambió.
+    """
+    ruta = os.path.join(BASE_DIR, _safe_filename_from_user(usuario))
+    with lock_csv:
+        if ruta not in ips_usuarios:
+            try:
+                ips_usuarios[ruta] = leer_csv(ruta)[0][0]
+            except Exception:
+                ips_usuarios[ruta] = None
+        if ips_usuarios[ruta] != ip:
+            ips_usuarios[ruta] = ip
+            csv_pendientes.add(ruta)
+
+
+def escribir_csv_pendientes() -> None:
+    """Escribe los CSV cuya IP cambió; si uno falla (p. ej. está abierto) se reintenta después."""
+    with lock_csv:
+        pendientes = {ruta: ips_usuarios[ruta] for ruta in csv_pendientes}
+        csv_pendientes.clear()
+    for ruta, ip in pendientes.items():
+        try:
+            guardar_ip_en_csv(ruta, ip)
+        except Exception as e:
+            print(f"[CSV]  Error al guardar CSV: {e}")
+            with lock_csv:
+                csv_pendientes.add(ruta)
+
+
+def manejar_csv():
     while True:
-        chunk = conn.recv(BUFFER_SIZE)
-        if not chunk:
-            if buf.strip():
-                try:
-                    return json.loads(buf.decode(errors="replace"))
-                except Exception as e:
-                    raise ConnectionError(f"Cierre sin JSON completo: {e}")
-            raise ConnectionError("Conexión cerrada por el cliente")
-        buf += chunk
-        if b"\n" in buf:
-            line, _, _ = buf.partition(b"\n")
-            return json.loads(line.decode(errors="replace"))
+        time.sleep(INTERVALO_CSV)
+        escribir_csv_pendientes()
+
+
+# ------------------- REPORTES -------------------
+
+def registrar_reporte(ip_cliente, hora, info):
+    """Guarda un reporte ya recibido: memoria, IP del usuario, historial y consola."""
+    usuario = info.get("usuario", "N/A")
+    sistema = info.get("sistema_operativo")
+    temperatura = info.get("temperatura_C")
+    ram_usada = info.get("ram_usada_MB", 0)
+    ram_total = info.get("ram_total_MB", 0)
+    servicios = info.get("servicios", {})
+
+    usuarios_conectados[ip_cliente] = {
+        "hora": hora,
+        "usuario": usuario,
+        "OS": sistema,
+        "temperatura": temperatura,
+        "ram_usada_MB": ram_usada,
+        "ram_total_MB": ram_total,
+        "servicios": servicios
+    }
+
+    # Anotar la IP; el CSV se escribe en segundo plano
+    registrar_ip(usuario, ip_cliente)
+
+    # Agregar la muestra al historial
+    if historial is not None:
+        historial.agregar({
+            "ip": ip_cliente,
+            "usuario": usuario,
+            "temperatura_C": temperatura,
+            "ram_usada_MB": ram_usada,
+            "ram_total_MB": ram_total,
+            "servicios": servicios
+        })
+
+    # Mostrar en consola (un solo print por reporte)
+    lineas = [
+        f"\n[TCP] Reporte de {ip_cliente}",
+        f"  Hora: {hora}",
+        f"  Usuario: {usuario}",
+        f"  OS: {sistema}",
+        f"  RAM usada: {ram_usada} MB / {ram_total} MB",
+        f"  Temp CPU: {temperatura if temperatura else 'N/A'} °C",
+    ]
+    if servicios:
+        lineas.append("  Servicios:")
+        for servicio, estado in servicios.items():
+            simbolo = "[OK]" if estado else "[X]"
+            lineas.append(f"    {simbolo} {servicio}")
+    else:
+        lineas.append("  No se reportaron servicios.")
+    print("\n".join(lineas))
+
+
+def procesar_reportes():
+    """
+    Hilo que saca los reportes de la cola y hace lo lento (JSON, CSV, consola),
+    para que el servidor TCP solo lea de los sockets.
+    """
+    ultimos = {}  # (ip, puerto) -> último reporte completo de esa conexión
+    while True:
+        cliente, hora, linea, tabla = cola_reportes.get()
+        if linea is None:  # La conexión se cerró
+            ultimos.pop(cliente, None)
+            continue
+        try:
+            if tabla is not None:
+                info = compacto.decodificar(tabla, linea, ultimos.get(cliente))
+            else:
+                info = json.loads(linea.decode(errors="replace"))
+                # Los reportes "delta" traen solo los campos que cambiaron
+                if info.pop("delta", False):
+                    info = {**ultimos.get(cliente, {}), **info}
+            ultimos[cliente] = info
+            registrar_reporte(cliente[0], hora, info)
+        except Exception as e:
+            print(f"[TCP] ⚠️ Error con {cliente[0]}: {e}")
+
+
+def encolar_reporte(cliente, linea, tabla=None):
+    """
+    Encola un reporte, o el cierre de la conexión si `linea` es None. Con la
+    cola llena los reportes se descartan (el cliente manda uno completo cada
+    tanto), pero el cierre siempre entra para liberar el estado de la conexión.
+    """
+    global reportes_descartados
+    if linea is not None and cola_reportes.qsize() >= MAX_COLA:
+        reportes_descartados += 1
+        if reportes_descartados % 100 == 1:
+            print(f"[TCP] ⚠️ Cola llena, {reportes_descartados} reportes descartados")
+        return
+    hora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cola_reportes.put_nowait((cliente, hora, linea, tabla))
 
 
 # ------------------- TCP -------------------
 
-def manejar_tcp():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as servidor:
-        servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        servidor.bind(("0.0.0.0", PUERTO_TCP))
-        servidor.listen()
-        print(f"[TCP] Servidor escuchando en el puerto {PUERTO_TCP}...\n")
+def leer_saludo(linea):
+    """El saludo (dict con la clave "hola") si la línea lo es; si no, None."""
+    try:
+        saludo = json.loads(linea.decode(errors="replace"))
+    except ValueError:
+        return None
+    if isinstance(saludo, dict) and "hola" in saludo:
+        return saludo
+    return None
+
+
+def negociar(saludo):
+    """
+    Respuesta al saludo de un cliente que propone el formato compacto: la
+    Tabla de campos (o None si se queda en JSON) y la línea a contestar.
+    """
+    try:
+        if saludo.get("formato") == compacto.VERSION:
+            tabla = compacto.Tabla(saludo["campos"])
+            return tabla, (json.dumps({"formato": compacto.VERSION}) + "\n").encode()
+    except (ValueError, KeyError, TypeError):
+        pass
+    return None, (json.dumps({"formato": "json"}) + "\n").encode()
+
+
+async def leer_trama(reader):
+    largo = int.from_bytes(await reader.readexactly(2), "big")
+    return await reader.readexactly(largo)
 
+
+async def atender_cliente(reader, writer):
+    """
+    Lee reportes de una conexión que el cliente deja abierta. Por defecto son
+    JSON separados por \\n: las líneas vacías son latidos y los reportes con
+    "delta" solo traen lo que cambió. Si la primera línea es un saludo ("hola")
+    se negocia el formato compacto y lo que sigue son tramas binarias.
+    Los clientes viejos mandan un solo JSON sin \\n y cierran; eso también se acepta.
+    """
+    cliente = writer.get_extra_info("peername")[:2]
+    ip_cliente = cliente[0]
+    print(f"[TCP] Cliente conectado: {ip_cliente}")
+    tabla = None
+    primera = True
+    try:
         while True:
-            conn, addr = servidor.accept()
-            ip_cliente = addr[0]
-            with conn:
-                try:
-                    info = recv_json_lines(conn)
-                    hora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    usuario = info.get("usuario", "N/A")
-                    sistema = info.get("sistema_operativo")
-                    temperatura = info.get("temperatura_C")
-                    ram_usada = info.get("ram_usada_MB", 0)
-                    ram_total = info.get("ram_total_MB", 0)
-                    servicios = info.get("servicios", {})
-
-                    usuarios_conectados[ip_cliente] = {
-                        "hora": hora,
-                        "usuario": usuario,
-                        "OS": sistema,
-                        "temperatura": temperatura,
-                        "ram_usada_MB": ram_usada,
-                        "ram_total_MB": ram_total,
-                        "servicios": servicios
-                    }
-
-                    # Guardar IP en CSV
-                    guardar_ip_en_csv(usuario, ip_cliente)
-
-                    # Mostrar en consola
-                    print(f"\n[TCP] Conexión desde {ip_cliente}")
-                    print(f"  Hora: {hora}")
-                    print(f"  Usuario: {usuario}")
-                    print(f"  OS: {sistema}")
-                    print(f"  RAM usada: {ram_usada} MB / {ram_total} MB")
-                    print(f"  Temp CPU: {temperatura if temperatura else 'N/A'} °C")
-                    if servicios:
-                        print("  Servicios:")
-                        for servicio, estado in servicios.items():
-                            simbolo = "[OK]" if estado else "[X]"
-                            print(f"    {simbolo} {servicio}")
-                    else:
-                        print("  No se reportaron servicios.")
-                except Exception as e:
-                    print(f"[TCP] ⚠️ Error con {ip_cliente}: {e}")
+            try:
+                if tabla is None:
+                    linea = await asyncio.wait_for(reader.readuntil(b"\n"), TIEMPO_LECTURA)
+                else:
+                    linea = await asyncio.wait_for(leer_trama(reader), TIEMPO_LECTURA)
+            except asyncio.IncompleteReadError as e:
+                if tabla is None and e.partial.strip():
+                    encolar_reporte(cliente, e.partial)
+                break
+            except asyncio.LimitOverrunError:
+                print(f"[TCP] ⚠️ Reporte de {ip_cliente} mayor a {MAX_REPORTE} bytes, se cierra la conexión")
+                break
+            except asyncio.TimeoutError:
+                print(f"[TCP] ⚠️ {ip_cliente} sin datos en {TIEMPO_LECTURA} s, se cierra la conexión")
+                break
+            saludo = leer_saludo(linea) if primera else None
+            primera = False
+            if saludo is not None:
+                tabla, respuesta = negociar(saludo)
+                writer.write(respuesta)
+                await writer.drain()
+                print(f"[TCP] {ip_cliente} usa formato {compacto.VERSION if tabla else 'json'}")
+            elif tabla is not None:
+                if linea:  # Las tramas vacías son latidos
+                    encolar_reporte(cliente, linea, tabla)
+            elif linea.strip():
+                encolar_reporte(cliente, linea)
+    except OSError as e:
+        print(f"[TCP] ⚠️ Error con {ip_cliente}: {e}")
+    finally:
+        print(f"[TCP] Cliente desconectado: {ip_cliente}")
+        encolar_reporte(cliente, None)
+        writer.close()
+
+
+async def servir_tcp():
+    servidor = await asyncio.start_server(atender_cliente, "0.0.0.0", PUERTO_TCP,
+                                          limit=MAX_REPORTE, backlog=1024, reuse_address=True)
+    print(f"[TCP] Servidor escuchando en el puerto {PUERTO_TCP}...\n")
+    async with servidor:
+        await servidor.serve_forever()
+
+
+def manejar_tcp():
+    asyncio.run(servir_tcp())
 
 
 # ------------------- UDP -------------------
 
+def respuesta_descubrimiento():
+    """
+    Respuesta al descubrimiento, con la IP local guardada durante TTL_IP_LOCAL
+    segundos en vez de calcularla en cada petición.
+    """
+    ahora = time.monotonic()
+    if ahora >= respuesta_cache["hasta"]:
+        respuesta = json.dumps({"ip": obtener_ip_local(), "tcp_port": PUERTO_TCP})
+        respuesta_cache.update(datos=respuesta.encode(), hasta=ahora + TTL_IP_LOCAL)
+    return respuesta_cache["datos"]
+
+
 def manejar_udp():
     TOKEN_REQUERIDO = os.environ.get("DISCOVERY_TOKEN", None)
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
@@ -146,8 +333,7 @@ def manejar_udp():
                 contenido = json.loads(mensaje.decode(errors="replace"))
                 if TOKEN_REQUERIDO and contenido.get("token") != TOKEN_REQUERIDO:
                     continue
-                respuesta = json.dumps({"ip": obtener_ip_local(), "tcp_port": PUERTO_TCP})
-                udp.sendto(respuesta.encode(), addr)
+                udp.sendto(respuesta_descubrimiento(), addr)
                 print(f"[UDP] Respuesta enviada a {addr[0]}")
             except Exception as e:
                 print(f"[UDP] ⚠️ Error: {e}")
@@ -157,9 +343,17 @@ def manejar_udp():
 # ------------------- MAIN -------------------
 
 if __name__ == "__main__":
+    historial = AlmacenTelemetria()
     hilo_tcp = threading.Thread(target=manejar_tcp, daemon=True)
     hilo_udp = threading.Thread(target=manejar_udp, daemon=True)
+    hilo_reportes = threading.Thread(target=procesar_reportes, daemon=True)
+    hilo_csv = threading.Thread(target=manejar_csv, daemon=True)
+    hilo_reportes.start()
+    hilo_csv.start()
     hilo_tcp.start()
     hilo_udp.start()
-    hilo_tcp.join()
-    hilo_udp.join()
+    try:
+        hilo_tcp.join()
+        hilo_udp.join()
+    except KeyboardInterrupt:
+        escribir_csv_pendientes()
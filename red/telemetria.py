@@ -0,0 +1,240 @@
+"""
+Historial de telemetría en segmentos NDJSON de solo-agregar.
+
+Cada muestra es una línea JSON con "t" (segundos epoch) e "ip" del host, más
+los campos que mande el cliente. Se escribe en el segmento activo; cuando
+pasa de TAM_SEGMENTO se cierra, se le guarda un índice por host
+(t mínimo, t máximo, muestras) y se abre otro. Así agregar una muestra cuesta
+lo mismo con un día o con meses de historial, y una consulta por host y rango
+de tiempo solo lee los segmentos que pueden tener datos.
+
+Los segmentos viejos se reducen a promedios por intervalo (compactar) y los
+más antiguos se borran cuando el total pasa de MAX_BYTES.
+
+Uso:
+    python telemetria.py importar usuarios_log.json
+    python telemetria.py consultar --ip 192.168.15.9 --desde 2025-08-03T11:00
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DIRECTORIO = os.path.join(BASE_DIR, "historial")
+TAM_SEGMENTO = 4 * 1024 * 1024  # bytes por segmento antes de rotar
+MAX_BYTES = 512 * 1024 * 1024  # tamaño total máximo del historial
+COMPACTAR_DESPUES = 7 * 24 * 3600  # segundos tras los que un segmento se reduce
+INTERVALO_COMPACTO = 60  # segundos por promedio en segmentos reducidos
+
+
+class AlmacenTelemetria:
+    def __init__(self, directorio=DIRECTORIO, tam_segmento=TAM_SEGMENTO, max_bytes=MAX_BYTES,
+                 compactar_despues=COMPACTAR_DESPUES, intervalo_compacto=INTERVALO_COMPACTO):
+        self.directorio = directorio
+        self.tam_segmento = tam_segmento
+        self.max_bytes = max_bytes
+        self.compactar_despues = compactar_despues
+        self.intervalo_compacto = intervalo_compacto
+        self.lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+
+        # número de segmento -> {"hosts": {ip: [t_min, t_max, n]}, "resolucion": s}
+        self.indices = {}
+        numeros = sorted(int(nombre.split(".")[0]) for nombre in os.listdir(directorio)
+                         if nombre.endswith(".ndjson"))
+        for numero in numeros[:-1]:
+            self.indices[numero] = self._leer_indice(numero)
+        self.activo = numeros[-1] if numeros else 0
+        # El índice del segmento activo solo vive en memoria; se reconstruye al arrancar
+        self.indices[self.activo] = self._indexar(self.activo)
+        self.archivo = open(self._ruta(self.activo), "a", encoding="utf-8")
+
+    # ------------------- Archivos -------------------
+
+    def _ruta(self, numero, extension="ndjson"):
+        return os.path.join(self.directorio, f"{numero:08d}.{extension}")
+
+    def _muestras(self, numero):
+        try:
+            with open(self._ruta(numero), encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        yield json.loads(linea)
+                    except ValueError:
+                        continue  # Línea a medias de un cierre brusco
+        except FileNotFoundError:
+            return
+
+    def _indexar(self, numero, resolucion=0):
+        indice = {"hosts": {}, "resolucion": resolucion}
+        for muestra in self._muestras(numero):
+            self._anotar(indice, muestra)
+        return indice
+
+    @staticmethod
+    def _anotar(indice, muestra):
+        rango = indice["hosts"].get(muestra["ip"])
+        t = muestra["t"]
+        if rango is None:
+            indice["hosts"][muestra["ip"]] = [t, t, 1]
+        else:
+            rango[0] = min(rango[0], t)
+            rango[1] = max(rango[1], t)
+            rango[2] += 1
+
+    def _leer_indice(self, numero):
+        try:
+            with open(self._ruta(numero, "idx"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            indice = self._indexar(numero)
+            self._guardar_indice(numero, indice)
+            return indice
+
+    def _guardar_indice(self, numero, indice):
+        temporal = self._ruta(numero, "idx.tmp")
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(indice, f)
+        os.replace(temporal, self._ruta(numero, "idx"))
+
+    # ------------------- Escritura -------------------
+
+    def agregar(self, muestra):
+        """Agrega una muestra (dict con "ip"; "t" se pone si falta)."""
+        muestra.setdefault("t", round(time.time(), 3))
+        linea = json.dumps(muestra, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.archivo.write(linea)
+            self.archivo.flush()
+            self._anotar(self.indices[self.activo], muestra)
+            if self.archivo.tell() >= self.tam_segmento:
+                self._rotar()
+
+    def _rotar(self):
+        self.archivo.close()
+        self._guardar_indice(self.activo, self.indices[self.activo])
+        self.activo += 1
+        self.indices[self.activo] = {"hosts": {}, "resolucion": 0}
+        self.archivo = open(self._ruta(self.activo), "a", encoding="utf-8")
+        self._compactar()
+        self._aplicar_retencion()
+
+    def _compactar(self):
+        """Reduce a promedios por intervalo los segmentos cerrados más viejos que compactar_despues."""
+        limite = time.time() - self.compactar_despues
+        for numero, indice in list(self.indices.items()):
+            if numero == self.activo or indice["resolucion"] or not indice["hosts"]:
+                continue
+            if max(rango[1] for rango in indice["hosts"].values()) > limite:
+                continue
+            cubetas = {}
+            for muestra in self._muestras(numero):
+                clave = (muestra["ip"], int(muestra["t"] // self.intervalo_compacto))
+                cubetas.setdefault(clave, []).append(muestra)
+            temporal = self._ruta(numero, "ndjson.tmp")
+            with open(temporal, "w", encoding="utf-8") as f:
+                for clave in sorted(cubetas, key=lambda clave: clave[1]):
+                    f.write(json.dumps(promediar(cubetas[clave]), ensure_ascii=False, separators=(",", ":")) + "\n")
+            os.replace(temporal, self._ruta(numero))
+            self.indices[numero] = self._indexar(numero, self.intervalo_compacto)
+            self._guardar_indice(numero, self.indices[numero])
+
+    def _aplicar_retencion(self):
+        """Borra los segmentos más viejos mientras el historial pase de max_bytes."""
+        tamanos = {numero: os.path.getsize(self._ruta(numero)) for numero in self.indices}
+        total = sum(tamanos.values())
+        for numero in sorted(self.indices):
+            if total <= self.max_bytes or numero == self.activo:
+                break
+            os.remove(self._ruta(numero))
+            try:
+                os.remove(self._ruta(numero, "idx"))
+            except FileNotFoundError:
+                pass
+            del self.indices[numero]
+            total -= tamanos[numero]
+
+    def cerrar(self):
+        with self.lock:
+            self.archivo.close()
+
+    # ------------------- Consultas -------------------
+
+    def consultar(self, ip=None, desde=None, hasta=None):
+        """Muestras de un host (o de todos) con desde <= t <= hasta, en orden de llegada."""
+        desde = float("-inf") if desde is None else desde
+        hasta = float("inf") if hasta is None else hasta
+        with self.lock:
+            self.archivo.flush()
+            candidatos = []
+            for numero in sorted(self.indices):
+                hosts = self.indices[numero]["hosts"]
+                if ip is None:
+                    rangos = hosts.values()
+                else:
+                    rangos = [hosts[ip]] if ip in hosts else []
+                if any(rango[0] <= hasta and rango[1] >= desde for rango in rangos):
+                    candidatos.append(numero)
+        for numero in candidatos:
+            for muestra in self._muestras(numero):
+                if (ip is None or muestra["ip"] == ip) and desde <= muestra["t"] <= hasta:
+                    yield muestra
+
+    def hosts(self):
+        with self.lock:
+            return sorted({ip for indice in self.indices.values() for ip in indice["hosts"]})
+
+
+def promediar(muestras):
+    """Una muestra con el promedio de los campos numéricos y el último valor de los demás."""
+    resultado = dict(muestras[-1])
+    for campo, valor in muestras[-1].items():
+        if campo == "ip" or isinstance(valor, bool) or not isinstance(valor, (int, float)):
+            continue
+        valores = [m[campo] for m in muestras
+                   if isinstance(m.get(campo), (int, float)) and not isinstance(m.get(campo), bool)]
+        resultado[campo] = round(sum(valores) / len(valores), 3)
+    resultado["n"] = sum(m.get("n", 1) for m in muestras)
+    return resultado
+
+
+def segundos(texto):
+    return None if texto is None else datetime.fromisoformat(texto).timestamp()
+
+
+def importar_json(almacen, ruta):
+    """Pasa un usuarios_log.json (arreglo JSON con "timestamp" ISO) al historial."""
+    with open(ruta, encoding="utf-8") as f:
+        muestras = json.load(f)
+    for muestra in muestras:
+        muestra = dict(muestra)
+        muestra["t"] = round(segundos(muestra.pop("timestamp")), 3)
+        almacen.agregar(muestra)
+    return len(muestras)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Historial de telemetría de los hosts.")
+    parser.add_argument("--directorio", default=DIRECTORIO)
+    sub = parser.add_subparsers(dest="comando", required=True)
+    importar = sub.add_parser("importar", help="Importar un usuarios_log.json")
+    importar.add_argument("ruta")
+    consultar = sub.add_parser("consultar", help="Imprimir muestras como NDJSON")
+    consultar.add_argument("--ip")
+    consultar.add_argument("--desde", help="Fecha ISO, p. ej. 2025-08-03T11:00")
+    consultar.add_argument("--hasta", help="Fecha ISO")
+    sub.add_parser("hosts", help="Listar los hosts con historial")
+    args = parser.parse_args()
+
+    almacen = AlmacenTelemetria(args.directorio)
+    if args.comando == "importar":
+        print(f"{importar_json(almacen, args.ruta)} muestras importadas en {args.directorio}")
+    elif args.comando == "consultar":
+        for muestra in almacen.consultar(args.ip, segundos(args.desde), segundos(args.hasta)):
+            print(json.dumps(muestra, ensure_ascii=False))
+    else:
+        print("\n".join(almacen.hosts()))
+    almacen.cerrar()
@@ -1,14 +1,16 @@
+import argparse
+import heapq
+import itertools
+import os
 import threading
 import time
-#import RPi.GPIO as GPIO
-from pythonosc import dispatcher, osc_server
+from pythonosc import dispatcher, osc_packet, osc_server
 import atexit
 import signal
 import sys
 
-# Desactiva advertencias de GPIO
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
+ALTO = 1
+BAJO = 0
 
 # Diccionario de solenoides: nombre -> pin GPIO
 solenoide_pines = {
@@ -25,22 +27,283 @@ solenoide_pines = {
 # Estado anterior para detección de flanco
 estados_anteriores = {nombre: 0.0 for nombre in solenoide_pines}
 
-# Configura todos los pines
-for pin in solenoide_pines.values():
-    GPIO.setup(pin, GPIO.OUT)
-    GPIO.output(pin, GPIO.LOW)
+# Presupuesto térmico de cada bobina (ver LimiteBobina); se puede ajustar por solenoide
+limites_por_defecto = {
+    "max_encendido": 0.15,  # s: un pulso más largo se recorta
+    "min_apagado": 0.01,    # s: descanso mínimo entre pulsos de la misma bobina
+    "ciclo_max": 0.5,       # fracción máxima de tiempo encendida dentro de la ventana
+    "ventana": 2.0,         # s
+    "max_diferido": 0.03,   # s: cuánto se puede retrasar un golpe antes de descartarlo
+}
+limites_solenoides = {nombre: dict(limites_por_defecto) for nombre in solenoide_pines}
+
+# Últimos segundos antes de un flanco que se esperan en activo, para bajar el jitter del sleep
+MARGEN_ESPERA_ACTIVA = 0.002
+
+# Timetags más lejanos que esto se consideran un reloj desfasado y se tocan al recibirse
+MAX_ADELANTO = 10.0
+
+# Imprime cada golpe en consola (--silencioso lo apaga; el print pesa a ritmos altos)
+VERBOSO = True
+
+
+class BackendRPi:
+    """RPi.GPIO: una llamada con listas de pines y niveles por lote de flancos."""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        # Desactiva advertencias de GPIO
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+
+    def configurar(self, pines):
+        for pin in pines:
+            self.GPIO.setup(pin, self.GPIO.OUT)
+            self.GPIO.output(pin, self.GPIO.LOW)
+
+    def escribir(self, niveles):
+        """niveles: {pin: ALTO | BAJO}, aplicados en una sola llamada."""
+        self.GPIO.output(list(niveles), list(niveles.values()))
+
+    def cerrar(self):
+        self.GPIO.cleanup()
+
+
+class BackendLgpio:
+    """lgpio: todos los pines se reclaman como un grupo y cada lote es un solo group_write."""
+
+    def __init__(self, chip=0):
+        import lgpio
+        self.lgpio = lgpio
+        self.chip = lgpio.gpiochip_open(chip)
+        self.pines = []
+
+    def configurar(self, pines):
+        self.pines = list(pines)
+        self.bit = {pin: 1 << i for i, pin in enumerate(self.pines)}
+        self.lgpio.group_claim_output(self.chip, self.pines, [BAJO] * len(self.pines))
+
+    def escribir(self, niveles):
+        valores = mascara = 0
+        for pin, nivel in niveles.items():
+            mascara |= self.bit[pin]
+            if nivel == ALTO:
+                valores |= self.bit[pin]
+        self.lgpio.group_write(self.chip, self.pines[0], valores, mascara)
+
+    def cerrar(self):
+        self.lgpio.group_write(self.chip, self.pines[0], 0)
+        self.lgpio.group_free(self.chip, self.pines[0])
+        self.lgpio.gpiochip_close(self.chip)
+
+
+class BackendSimulado:
+    """
+    Sin hardware: guarda el nivel de cada pin y registra cada flanco con su
+    tiempo monotónico exacto, para medir rendimiento y jitter en cualquier equipo.
+    """
+
+    def __init__(self):
+        self.niveles = {}
+        self.escrituras = 0
+        self.flancos = []  # (tiempo, pin, nivel) de cada cambio de nivel
+        self.al_escribir = None  # Opcional: al_escribir(tiempo, niveles), para benchmarks
+
+    def configurar(self, pines):
+        self.niveles = {pin: BAJO for pin in pines}
+
+    def escribir(self, niveles):
+        tiempo = time.monotonic()
+        for pin, nivel in niveles.items():
+            if self.niveles.get(pin) != nivel:
+                self.flancos.append((tiempo, pin, nivel))
+        self.niveles.update(niveles)
+        self.escrituras += 1
+        if self.al_escribir is not None:
+            self.al_escribir(tiempo, niveles)
+
+    def pulsos(self):
+        """Reconstruye los pulsos registrados como (pin, inicio, fin)."""
+        encendidos, pulsos = {}, []
+        for tiempo, pin, nivel in self.flancos:
+            if nivel == ALTO:
+                encendidos[pin] = tiempo
+            elif pin in encendidos:
+                pulsos.append((pin, encendidos.pop(pin), tiempo))
+        return pulsos
+
+    def cerrar(self):
+        print(f"Backend simulado: {len(self.flancos)} flancos en {self.escrituras} escrituras")
+
+
+backends = {"rpi": BackendRPi, "lgpio": BackendLgpio, "simulado": BackendSimulado}
+
+
+class LimiteBobina:
+    """
+    Presupuesto de una bobina: tiempo máximo encendida por pulso, descanso
+    mínimo entre pulsos y ciclo de trabajo máximo en una ventana móvil.
+    Los golpes que no caben se retrasan (hasta max_diferido) o se descartan,
+    y se cuentan.
+    """
+
+    def __init__(self, max_encendido, min_apagado, ciclo_max, ventana, max_diferido=0.0):
+        self.max_encendido = max_encendido
+        self.min_apagado = min_apagado
+        self.ciclo_max = ciclo_max
+        self.ventana = ventana
+        self.max_diferido = max_diferido
+        self.pulsos = []  # (inicio, fin) admitidos que aún pesan en la ventana
+        self.recortados = 0
+        self.diferidos = 0
+        self.descartados = 0
+
+    def _choque(self, inicio, fin):
+        """Fin del primer pulso que no deja el descanso mínimo con [inicio, fin], o None."""
+        for a, b in self.pulsos:
+            if a < fin + self.min_apagado and inicio < b + self.min_apagado:
+                return b
+        return None
+
+    def admitir(self, inicio, duracion, ahora):
+        """Devuelve (inicio, duracion) ajustados al presupuesto, o None si el golpe se descarta."""
+        self.pulsos = [(a, b) for a, b in self.pulsos if b > ahora - self.ventana]
+        if duracion > self.max_encendido:
+            duracion = self.max_encendido
+            self.recortados += 1
+        pedido = inicio
+        fin_choque = self._choque(inicio, inicio + duracion)
+        while fin_choque is not None:
+            inicio = fin_choque + self.min_apagado
+            if inicio - pedido > self.max_diferido:
+                self.descartados += 1
+                return None
+            fin_choque = self._choque(inicio, inicio + duracion)
+        if inicio > pedido:
+            self.diferidos += 1
+        fin = inicio + duracion
+        desde = fin - self.ventana
+        encendido = sum(min(b, fin) - max(a, desde) for a, b in self.pulsos if b > desde)
+        if encendido + duracion > self.ciclo_max * self.ventana:
+            self.descartados += 1
+            return None
+        self.pulsos.append((inicio, fin))
+        return inicio, duracion
+
+    def resumen(self):
+        return f"{self.recortados} recortados, {self.diferidos} diferidos, {self.descartados} descartados"
+
+
+class PlanificadorPulsos:
+    """
+    Dispara todos los pulsos desde un solo hilo.
+    Cada pulso se convierte en dos flancos (encendido y apagado) guardados en un
+    heap ordenado por tiempo; el hilo duerme hasta el siguiente flanco y espera
+    en activo los últimos milisegundos. Así los handlers OSC no bloquean y el
+    número de hilos no crece con el ritmo.
+    Si un pin tiene LimiteBobina, cada pulso pasa antes por su presupuesto.
+    Los flancos que vencen juntos (por ejemplo un acorde) salen en una sola
+    escritura al backend.
+    """
+
+    def __init__(self, escribir, limites=None):
+        self.escribir = escribir  # escribir({pin: nivel})
+        self.limites = limites or {}  # pin -> LimiteBobina
+        self.eventos = []  # heap de (tiempo, secuencia, pin, nivel)
+        self.pulsos_activos = {}  # pin -> pulsos encendidos que aún no terminan
+        self.atrasados = 0  # Pulsos cuyo BAJO se corrió porque el hilo llegó tarde al ALTO
+        self.secuencia = itertools.count()
+        self.condicion = threading.Condition()
+        self.activo = True
+        self.hilo = threading.Thread(target=self._bucle, daemon=True)
+        self.hilo.start()
+
+    def pulso(self, pin, duracion, inicio=None):
+        """
+        Programa un pulso de `duracion` segundos en `pin` (ahora o en el tiempo
+        monotónico `inicio`). Devuelve False si el presupuesto de la bobina lo descarta.
+        """
+        ahora = time.monotonic()
+        inicio = ahora if inicio is None else inicio
+        with self.condicion:
+            limite = self.limites.get(pin)
+            if limite is not None:
+                admitido = limite.admitir(inicio, duracion, ahora)
+                if admitido is None:
+                    return False
+                inicio, duracion = admitido
+            fin = inicio + duracion
+            heapq.heappush(self.eventos, (inicio, next(self.secuencia), pin, ALTO))
+            heapq.heappush(self.eventos, (fin, next(self.secuencia), pin, BAJO))
+            self.condicion.notify()
+        return True
+
+    def acorde(self, pines, duracion, inicio=None):
+        """Programa el mismo pulso en varios pines a la vez; devuelve los pines descartados."""
+        inicio = time.monotonic() if inicio is None else inicio
+        with self.condicion:
+            return [pin for pin in pines if not self.pulso(pin, duracion, inicio)]
+
+    def _bucle(self):
+        while True:
+            with self.condicion:
+                while self.activo and not self.eventos:
+                    self.condicion.wait()
+                if not self.activo:
+                    return
+                objetivo = self.eventos[0][0]
+                espera = objetivo - time.monotonic()
+                if espera > MARGEN_ESPERA_ACTIVA:
+                    self.condicion.wait(espera - MARGEN_ESPERA_ACTIVA)
+                    continue
+            # Espera activa hasta el flanco (fuera del lock para no frenar a los handlers)
+            while time.monotonic() < objetivo:
+                pass
+            ahora = time.monotonic()
+            lote = {}
+            encendidos = {}  # pin -> tiempo programado del ALTO que sale en este lote
+            with self.condicion:
+                while self.eventos and self.eventos[0][0] <= ahora:
+                    tiempo, _, pin, nivel = heapq.heappop(self.eventos)
+                    if nivel == BAJO and pin in encendidos:
+                        # El hilo despertó tarde y el pulso entero cayó en este lote: el BAJO
+                        # pisaría al ALTO y la bobina no dispararía. Se corre por el retraso.
+                        heapq.heappush(self.eventos, (ahora + tiempo - encendidos[pin], next(self.secuencia), pin, BAJO))
+                        self.atrasados += 1
+                        continue
+                    if nivel == ALTO:
+                        encendidos[pin] = tiempo
+                    # Pulsos encimados en el mismo pin se suman: sólo se apaga al terminar el último
+                    activos = self.pulsos_activos.get(pin, 0) + (1 if nivel == ALTO else -1)
+                    self.pulsos_activos[pin] = activos
+                    if nivel == ALTO or activos == 0:
+                        lote[pin] = nivel
+                if lote:
+                    self.escribir(lote)
+
+    def detener(self):
+        with self.condicion:
+            self.activo = False
+            self.eventos.clear()
+            self.condicion.notify()
+        self.hilo.join()
+
+# Backend, planificador y despachador; los crea preparar()
+backend = None
+planificador = None
+disp = None
 
 # Función para apagar todos los solenoides de forma segura
 def apagar_todos():
     print("Apagando todos los solenoides...")
+    planificador.detener()
     for nombre, pin in solenoide_pines.items():
-        GPIO.output(pin, GPIO.LOW)
-    GPIO.cleanup()
-
-# Registra limpieza para salidas normales y errores
-atexit.register(apagar_todos)
-signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
-signal.signal(signal.SIGINT, lambda sig, frame: sys.exit(0))
+        print(f"  {nombre}: {planificador.limites[pin].resumen()}")
+    if planificador.atrasados:
+        print(f"  {planificador.atrasados} pulsos con el apagado corrido por llegar tarde")
+    backend.escribir({pin: BAJO for pin in solenoide_pines.values()})
+    backend.cerrar()
 
 # Función de activación con flanco
 def manejar_solenoide(address, *args):
@@ -62,29 +325,112 @@ def manejar_solenoide(address, *args):
     if valor_anterior == 0 and valor > 0:
         duracion = valor  # en segundos
         pin = solenoide_pines[nombre]
-        print(f"Percute: {nombre} por {duracion:.3f}s (GPIO {pin})")
+        ahora = time.monotonic()
+        adelanto = disp.tiempo - ahora  # > 0 si llegó en un bundle con timetag futuro
+        if adelanto > MAX_ADELANTO:
+            print(f"Timetag {adelanto:.1f}s en el futuro para {nombre}: ¿relojes sin sincronizar? Se toca ya.")
+            adelanto = 0.0
+        if VERBOSO:
+            print(f"Percute: {nombre} por {duracion:.3f}s (GPIO {pin}) en {max(adelanto, 0.0) * 1000:.1f} ms")
 
-        GPIO.output(pin, GPIO.HIGH)
-        time.sleep(duracion)
-        GPIO.output(pin, GPIO.LOW)
+        if not planificador.pulso(pin, duracion, ahora + max(adelanto, 0.0)):
+            print(f"Descartado: {nombre} excede su presupuesto térmico")
 
     # Actualiza estado
     estados_anteriores[nombre] = valor
 
-# Configura despachador OSC
-disp = dispatcher.Dispatcher()
-for solenoide in solenoide_pines:
-    disp.map(f"/{solenoide}", manejar_solenoide)
-
-# Inicia servidor OSC
-ip_escucha = "0.0.0.0"
-puerto_escucha = 8000
-servidor = osc_server.ThreadingOSCUDPServer((ip_escucha, puerto_escucha), disp)
-print(f"Servidor OSC escuchando en {ip_escucha}:{puerto_escucha}")
-
-try:
-    servidor.serve_forever()
-except Exception as e:
-    print(f"Error inesperado: {e}")
-finally:
-    apagar_todos()
+class DespachadorTemporizado(dispatcher.Dispatcher):
+    """
+    Dispatcher que no duerme hasta el timetag de los bundles: entrega cada
+    mensaje al llegar y deja su hora pedida (en reloj monotónico) en
+    `self.tiempo`, para que el planificador lo dispare a esa hora exacta.
+    Los mensajes sueltos y los bundles "inmediatos" llevan la hora de llegada.
+    El emisor debe tener el reloj sincronizado (NTP) con la Raspberry.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.tiempo = 0.0
+
+    def call_handlers_for_packet(self, data, client_address):
+        try:
+            paquete = osc_packet.OscPacket(data)
+        except osc_packet.ParseError:
+            return []
+        desfase = time.monotonic() - time.time()  # Timetags vienen en tiempo de pared
+        for mensaje in paquete.messages:
+            self.tiempo = mensaje.time + desfase
+            for handler in self.handlers_for_address(mensaje.message.address):
+                handler.invoke(client_address, mensaje.message)
+        return []
+
+# Acorde: varios solenoides en el mismo instante y con una sola escritura GPIO
+def manejar_acorde(address, *args):
+    """/chord <máscara> <duración>: bit 0 = solenoide_uno ... bit 7 = solenoide_ocho."""
+    try:
+        mascara = int(args[0])
+        duracion = float(args[1])
+    except (IndexError, ValueError):
+        print(f"Acorde inválido: {args}")
+        return
+    nombres = [nombre for i, nombre in enumerate(solenoide_pines) if mascara >> i & 1]
+    if not nombres or duracion <= 0:
+        return
+    ahora = time.monotonic()
+    adelanto = disp.tiempo - ahora
+    inicio = ahora + (adelanto if 0 < adelanto <= MAX_ADELANTO else 0.0)
+    if VERBOSO:
+        print(f"Acorde: {', '.join(nombres)} por {duracion:.3f}s")
+    descartados = planificador.acorde([solenoide_pines[nombre] for nombre in nombres], duracion, inicio)
+    if descartados:
+        print(f"Descartados del acorde (presupuesto térmico): GPIO {descartados}")
+
+def preparar(nombre_backend=None):
+    """
+    Configura los pines en el backend elegido (rpi, lgpio o simulado; por defecto
+    SOLENOIDES_BACKEND o rpi), arranca el planificador y arma el despachador OSC.
+    """
+    global backend, planificador, disp
+    backend = backends[nombre_backend or os.environ.get("SOLENOIDES_BACKEND", "rpi")]()
+    backend.configurar(solenoide_pines.values())
+
+    planificador = PlanificadorPulsos(backend.escribir, {
+        solenoide_pines[nombre]: LimiteBobina(**limites) for nombre, limites in limites_solenoides.items()
+    })
+
+    # Configura despachador OSC
+    disp = DespachadorTemporizado()
+    for solenoide in solenoide_pines:
+        disp.map(f"/{solenoide}", manejar_solenoide)
+    disp.map("/chord", manejar_acorde)
+    return disp
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor OSC de solenoides.")
+    parser.add_argument("--backend", choices=sorted(backends), help="Salida GPIO (por defecto SOLENOIDES_BACKEND o rpi)")
+    parser.add_argument("--ip", default="0.0.0.0")
+    parser.add_argument("--puerto", type=int, default=8000)
+    parser.add_argument("--silencioso", action="store_true", help="No imprimir cada golpe")
+    args = parser.parse_args(argv)
+
+    global VERBOSO
+    VERBOSO = not args.silencioso
+
+    preparar(args.backend)
+
+    # Registra limpieza para salidas normales y errores
+    atexit.register(apagar_todos)
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, lambda sig, frame: sys.exit(0))
+
+    # Inicia servidor OSC (un solo hilo basta: los handlers ya no duermen)
+    servidor = osc_server.BlockingOSCUDPServer((args.ip, args.puerto), disp)
+    print(f"Servidor OSC escuchando en {args.ip}:{args.puerto}")
+
+    try:
+        servidor.serve_forever()
+    except Exception as e:
+        print(f"Error inesperado: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,166 @@
 import time
-while True: 
-    for i in range(1, 6):
-        hostname = f"pinball{i}game"
-        role_module.main.hosts.hostnames[hostname].cmd_lefttube_launch()
-        time.sleep(2)
-        role_module.main.hosts.hostnames[hostname].cmd_righttube_launch()
-        time.sleep(2)
-        role_module.main.hosts.hostnames[hostname].cmd_kicker_launch()
-        time.sleep(2)
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Soak test for the pinball coils: every host runs its own pattern in its own
+# worker, so a slow or hung cabinet only delays itself and a cycle takes the
+# same time whether there are five machines or fifty.
+# `role_module` is provided by the environment this script runs in.
+
+# Patterns: hostname -> list of (coil, seconds after each shot, repeat).
+# A coil "x" fires host.cmd_x_launch(); "*" is the pattern for every other host.
+# Each pattern loops until the test is stopped.
+PATTERNS = {
+    "*": [
+        ("lefttube", 2, 1),
+        ("righttube", 2, 1),
+        ("kicker", 2, 1),
+    ],
+    # "pinball3game": [("kicker", 0.25, 8), ("lefttube", 2, 1)],
+}
+TIMEOUT = 5  # Seconds before a command counts as timed out
+REPORT_EVERY = 10  # Seconds between reports
+LATENCY_WINDOW = 1000  # Latest latencies kept per host and coil for the percentiles
+
+
+def pattern_for(hostname):
+    return PATTERNS.get(hostname, PATTERNS["*"])
+
+
+def command(coil):
+    return f"cmd_{coil}_launch"
+
+
+class Timings:
+    """
+    Per (host, coil) counters, the latest LATENCY_WINDOW latencies and the last
+    failure, summarized per host and per coil. Memory stays the same however
+    long the test runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}  # (hostname, coil) -> [calls, failures, deque of latencies in ms, last failure or None]
+
+    def add(self, hostname, coil, issued, completed, status, error=None):
+        with self.lock:
+            stats = self.stats.get((hostname, coil))
+            if stats is None:
+                stats = self.stats[(hostname, coil)] = [0, 0, deque(maxlen=LATENCY_WINDOW), None]
+            stats[0] += 1
+            if status == "ok":
+                stats[2].append((completed - issued) * 1000)
+            else:
+                stats[1] += 1
+                stats[3] = (issued, status, error)
+
+    def report(self):
+        with self.lock:
+            stats = {key: (calls, failures, list(latencies), last)
+                     for key, (calls, failures, latencies, last) in self.stats.items()}
+        for title, index in (("host", 0), ("coil", 1)):
+            groups = {}
+            for key, (calls, failures, latencies, last) in stats.items():
+                group = groups.setdefault(key[index], [0, 0, [], None])
+                group[0] += calls
+                group[1] += failures
+                group[2] += latencies
+                if last is not None and (group[3] is None or last[0] > group[3][0]):
+                    group[3] = last
+            print(f"{title:<14} {'calls':>6} {'fail':>5} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}  last failure")
+            for name in sorted(groups):
+                calls, failures, latencies, last = groups[name]
+                latencies.sort()
+                last = f"{last[1]}: {last[2]!r}" if last else ""
+                print(f"{name:<14} {calls:>6} {failures:>5} {percentile(latencies, 0.5):>8.1f} "
+                      f"{percentile(latencies, 0.9):>8.1f} {percentile(latencies, 0.99):>8.1f} "
+                      f"{percentile(latencies, 1.0):>8.1f}  {last}")
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Call:
+    """
+    One host command running in its own daemon thread. A call that never
+    returns is simply abandoned, so it can't keep the script from exiting
+    (executor threads are joined at interpreter exit).
+    """
+
+    def __init__(self, function):
+        self.done = threading.Event()
+        self.error = None
+        threading.Thread(target=self.run, args=(function,), daemon=True).start()
+
+    def run(self, function):
+        try:
+            function()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+def run_host(hostname, host, pattern, timings, stop):
+    """Loop over the host's pattern until `stop` is set, timing every call."""
+    pending = None
+    while not stop.is_set():
+        for coil, delay, repeat in pattern:
+            for _ in range(repeat):
+                if stop.is_set():
+                    return
+                issued = time.monotonic()
+                if pending is not None and not pending.done.is_set():
+                    # The previous call is still hung; don't pile more onto this host
+                    timings.add(hostname, coil, issued, None, "busy", "previous call still running")
+                else:
+                    pending = Call(getattr(host, command(coil)))
+                    if not pending.done.wait(TIMEOUT):
+                        timings.add(hostname, coil, issued, None, "timeout", f"more than {TIMEOUT}s")
+                    elif pending.error is not None:
+                        timings.add(hostname, coil, issued, time.monotonic(), "error", pending.error)
+                    else:
+                        timings.add(hostname, coil, issued, time.monotonic(), "ok")
+                # Keep the pattern's rate: wait from the issue time, not from completion
+                stop.wait(max(0.0, issued + delay - time.monotonic()))
+
+
+def report_worker_error(hostname, worker):
+    """A worker that dies stops adding rows for its host, so say why."""
+    if not worker.cancelled() and worker.exception() is not None:
+        print(f"{hostname}: worker stopped: {worker.exception()!r}")
+
+
+def run(hostnames=None):
+    hosts = role_module.main.hosts.hostnames
+    if hostnames is None:
+        hostnames = [name for name, host in hosts.items()
+                     if all(hasattr(host, command(coil)) for coil, _, _ in pattern_for(name))]
+    timings = Timings()
+    if not hostnames:
+        print("No host has the commands in its pattern; nothing to test.")
+        return timings
+    stop = threading.Event()
+    # Workers never block for more than TIMEOUT, so joining them on exit is bounded
+    workers = ThreadPoolExecutor(max_workers=len(hostnames))
+    for name in hostnames:
+        worker = workers.submit(run_host, name, hosts[name], pattern_for(name), timings, stop)
+        worker.add_done_callback(lambda worker, name=name: report_worker_error(name, worker))
+    try:
+        while True:
+            time.sleep(REPORT_EVERY)
+            timings.report()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        workers.shutdown(wait=True)
+        timings.report()
+    return timings
+
+
+run()